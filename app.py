@@ -1,29 +1,29 @@
-from main_workflow import graph
 import streamlit as st
 from datetime import datetime
-import time
 import os
+import uuid
 import tempfile
-from dotenv import load_dotenv
-from langchain_groq import ChatGroq
-from pydantic import BaseModel,Field
-from typing import Literal
-from invoking import get_audio_output_from_graph,get_labels_output_from_graph
-from invoking import get_mail_output_from_graph,get_output_from_graph,get_web_output_from_graph
+from main_workflow import classify_request
+from invoking import GraphRequest,stream_progress
 
-load_dotenv()
+def render_progress(request,status):
+    # every step of the graph is written into the status box as it finishes, merged web searches add each source's answer once it returns
+    response = None
 
-groq_api_key = os.getenv('GROQ_API_KEY')
+    # requests of one browser session share a checkpointed conversation, so "remove the labels" finds the earlier sort
+    request = request.model_copy(update={'thread_id':st.session_state.setdefault('thread_id',uuid.uuid4().hex)})
 
-llm = ChatGroq(model='llama-3.3-70b-versatile',api_key=groq_api_key)
+    for kind,payload in stream_progress(request):
+        if kind == 'progress':
+            status.write(payload)
+        elif kind == 'partial':
+            status.write(payload)
+        else:
+            response = payload
 
-class Node_Selector(BaseModel):
-    node : Literal['send_mail','schedule_meeting','sort_mail','web_search','transcribe'] = Field(
-        ...,
-        description = 'Given user query based on which the node among these four should be selected.Removing labels is also considered in sort_mail'
-    )
+    status.update(label="✅ Done", state="complete")
 
-structured_llm = llm.with_structured_output(Node_Selector)
+    return response
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(page_title="Repetative MultiTask Agent", page_icon="🤖", layout="wide")
@@ -97,10 +97,17 @@ st.markdown("<p class='subtitle'>An intelligent AI agent that automates email ha
 # --- USER QUERY INPUT ---
 query = st.text_area("💬 Type your query here...", placeholder="e.g., Schedule a meeting with John at 5 PM today.")
 print(query)
-Node = structured_llm.invoke(query)
 
 if query:
-    if Node.node == 'transcribe':
+    # the same structured call picks the page flow here and routes the graph, see invoking.build_inputs.
+    # streamlit reruns the script on every widget interaction so the intent is kept per query
+    if st.session_state.get('intent_query') != query:
+        st.session_state['intent'] = classify_request(query)
+        st.session_state['intent_query'] = query
+
+    intent = st.session_state['intent']
+
+    if intent.route == 'transcribe':
         file = st.file_uploader('upload_here')
         if file:
             file_ext = os.path.splitext(file.name)[-1]
@@ -111,16 +118,14 @@ if query:
             if st.button("Submit", key="submit-btn"):
                 if query.strip():
                     st.session_state["loading"] = True
-                    with st.spinner("🤖 Processing your request..."):
-                        time.sleep(2)  # Simulate AI processing
-
-                        response = get_audio_output_from_graph(temp_file_path,query)
+                    with st.status("🤖 Processing your request...", expanded=True) as status:
+                        response = render_progress(GraphRequest(kind='audio',query=query,audio_file=temp_file_path,intent=intent),status)
 
                         st.session_state['response'] = response
 
                         st.session_state["action"] = "transcribe_audio"
 
-    elif Node.node == 'send_mail':
+    elif intent.route == 'send_mail':
         file = st.file_uploader('upload attachment here')
         if file:
             file_ext = os.path.splitext(file.name)[-1]
@@ -131,10 +136,8 @@ if query:
             if st.button("Submit", key="submit-btn"):
                 if query.strip():
                     st.session_state["loading"] = True
-                    with st.spinner("🤖 Processing your request..."):
-                        time.sleep(2)  # Simulate AI processing
-
-                        response = get_mail_output_from_graph(query,temp_file_path)
+                    with st.status("🤖 Processing your request...", expanded=True) as status:
+                        response = render_progress(GraphRequest(kind='mail',query=query,attachment_file=temp_file_path,intent=intent),status)
 
                         st.session_state['response'] = response
 
@@ -145,10 +148,8 @@ if query:
             if st.button("Submit", key="submit-btn"):
                 if query.strip():
                     st.session_state["loading"] = True
-                    with st.spinner("🤖 Processing your request..."):
-                        time.sleep(2)  # Simulate AI processing
-
-                        response = get_mail_output_from_graph(query)
+                    with st.status("🤖 Processing your request...", expanded=True) as status:
+                        response = render_progress(GraphRequest(kind='mail',query=query,intent=intent),status)
 
                         st.session_state['response'] = response
 
@@ -156,32 +157,42 @@ if query:
 
                     st.session_state["loading"] = False
 
-    elif Node.node == 'sort_mail':
+    elif intent.route == 'sort_mail':
+        # asked before the button, a widget created inside the button branch is gone on the next rerun
+        criteria = st.text_input('***criteria***',value=intent.criteria or '',placeholder='sender or subject based on which labels to be created or have created earlier')
+
         if st.button("Submit", key="submit-btn"):
             if query.strip():
                 st.session_state["loading"] = True
-                with st.spinner("🤖 Processing your request..."):
-                    time.sleep(2)  # Simulate AI processing
-
-                    criteria = st.text_input('***criteria***',placeholder='sender or subject based on which labels to be created or have created earlier')
-
+                with st.status("🤖 Processing your request...", expanded=True) as status:
                     if criteria:
-                        response = get_labels_output_from_graph(query,criteria)
+                        response = render_progress(GraphRequest(kind='labels',query=query,criteria=criteria,intent=intent),status)
 
                         st.session_state['response'] = response
 
                         st.session_state["action"] = "sort_mail"
 
                 st.session_state["loading"] = False
-                
-    elif Node.node == 'web_search':
+
+    elif intent.route == 'remove_labels':
         if st.button("Submit", key="submit-btn"):
             if query.strip():
                 st.session_state["loading"] = True
-                with st.spinner("🤖 Processing your request..."):
-                    time.sleep(2)  # Simulate AI processing
+                with st.status("🤖 Processing your request...", expanded=True) as status:
+                    response = render_progress(GraphRequest(kind='remove',query=query,intent=intent),status)
 
-                    response = get_web_output_from_graph(query)
+                    st.session_state['response'] = response
+
+                    st.session_state["action"] = "remove_labels"
+
+                st.session_state["loading"] = False
+                
+    elif intent.route == 'web_search':
+        if st.button("Submit", key="submit-btn"):
+            if query.strip():
+                st.session_state["loading"] = True
+                with st.status("🤖 Processing your request...", expanded=True) as status:
+                    response = render_progress(GraphRequest(kind='web',query=query,intent=intent),status)
 
                     st.session_state['response'] = response
 
@@ -193,10 +204,8 @@ if query:
         if st.button("Submit", key="submit-btn"):
             if query.strip():
                 st.session_state["loading"] = True
-                with st.spinner("🤖 Processing your request..."):
-                    time.sleep(2)  # Simulate AI processing
-
-                    response = get_output_from_graph(query)
+                with st.status("🤖 Processing your request...", expanded=True) as status:
+                    response = render_progress(GraphRequest(kind='meeting',query=query,intent=intent),status)
 
                     st.session_state['response'] = response
 
@@ -217,6 +226,10 @@ if "action" in st.session_state:
     elif action == "sort_mail":
         st.markdown("<div class='success-box'>📂 Emails Sorted Successfully!</div>", unsafe_allow_html=True)
 
+    elif action == "remove_labels":
+        st.markdown("<div class='success-box'>🗑️ Labels Removed!</div>", unsafe_allow_html=True)
+        st.write(st.session_state['response'])
+
     elif action == "schedule_meeting":
         st.markdown("<div class='success-box'>📅 Meeting Scheduled Successfully!</div>", unsafe_allow_html=True)
         if 'response' in st.session_state:
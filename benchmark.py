@@ -0,0 +1,452 @@
+'''
+Offline benchmark of the workflow graph.
+
+Groq (chat and Whisper), Gmail, Calendar, SerpAPI and Wikipedia are replaced by local stand-ins
+with configurable latency and payload sizes, the graph then runs end to end for every route.
+
+    python benchmark.py --scenario sort_mail --mailbox-size 10000
+    python benchmark.py --scenario all --iterations 20 --concurrency 4 --json
+'''
+import os
+import time
+import json
+import random
+import tempfile
+import argparse
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from datetime import datetime,timedelta
+
+import main_workflow
+
+"""***Stand-ins***"""
+
+class Upstream:
+    '''
+    Latency and call counting shared by the stand-ins of one upstream.
+    '''
+    def __init__(self,name,latency,calls):
+        self.name = name
+        self.latency = latency
+        self.calls = calls
+        self._lock = threading.Lock()
+
+    def call(self,method,count=1):
+        with self._lock:
+            self.calls[f'{self.name}.{method}'] += count
+
+        if self.latency:
+            time.sleep(self.latency)
+
+class FakeRequest:
+    def __init__(self,upstream,method,response):
+        self.upstream = upstream
+        self.method = method
+        self.response = response
+
+    def execute(self):
+        self.upstream.call(self.method)
+        return self.response()
+
+    def next_chunk(self):
+        return None,self.execute()
+
+class FakeBatch:
+    # one round trip for the whole batch, the callbacks see every item
+    def __init__(self,upstream,callback):
+        self.upstream = upstream
+        self.callback = callback
+        self.requests = []
+
+    def add(self,request,request_id=None):
+        self.requests.append((request_id,request))
+
+    def execute(self):
+        self.upstream.call('batch')
+
+        for request_id,request in self.requests:
+            self.upstream.calls[f'{self.upstream.name}.{request.method}'] += 1
+            self.callback(request_id,request.response(),None)
+
+class FakeGmail:
+    '''
+    Gmail users() resource over a synthetic mailbox of mailbox_size messages
+    spread over `senders` senders and `subjects` subjects.
+    '''
+    def __init__(self,upstream,mailbox_size,senders=200,subjects=500,snippet_bytes=200,new_mail=0):
+        self.upstream = upstream
+        self.ids = [f'{i:016x}' for i in range(mailbox_size)]
+        self.new_mail = new_mail
+        self.senders = senders
+        self.subjects = subjects
+        self.snippet = 'x'*snippet_bytes
+        self.labels_by_id = {}
+        self._lock = threading.Lock()
+
+    # the resource chain of googleapiclient, users().messages().get(...) etc.
+    def users(self):
+        return self
+
+    def messages(self):
+        return SimpleNamespace(list=self._list,get=self._get,batchModify=self._batch_modify,modify=self._modify,send=self._send)
+
+    def labels(self):
+        return SimpleNamespace(list=self._labels_list,create=self._labels_create,delete=self._labels_delete)
+
+    def history(self):
+        return SimpleNamespace(list=self._history_list)
+
+    def getProfile(self,userId):
+        return FakeRequest(self.upstream,'getProfile',lambda:{'emailAddress':'me@example.com','historyId':'1000'})
+
+    def new_batch_http_request(self,callback=None):
+        return FakeBatch(self.upstream,callback)
+
+    def _list(self,userId,q='',maxResults=100,pageToken=None):
+        start = int(pageToken or 0)
+        end = min(start+maxResults,len(self.ids))
+
+        def response():
+            page = {'messages':[{'id':msg_id,'threadId':msg_id} for msg_id in self.ids[start:end]]}
+            if end < len(self.ids):
+                page['nextPageToken'] = str(end)
+            return page
+
+        return FakeRequest(self.upstream,'messages.list',response)
+
+    def _history_list(self,userId,startHistoryId,historyTypes=None,maxResults=100,pageToken=None):
+        # every run finds the last new_mail messages of the mailbox added since its cursor
+        new_ids = self.ids[len(self.ids)-self.new_mail:] if self.new_mail else []
+        start = int(pageToken or 0)
+        end = min(start+maxResults,len(new_ids))
+
+        def response():
+            page = {'history':[{'messagesAdded':[{'message':{'id':msg_id}}]} for msg_id in new_ids[start:end]],'historyId':'1000'}
+            if end < len(new_ids):
+                page['nextPageToken'] = str(end)
+            return page
+
+        return FakeRequest(self.upstream,'history.list',response)
+
+    def _get(self,userId,id,format='full',metadataHeaders=None):
+        index = int(id,16)
+
+        def response():
+            return {
+                'id':id,
+                'snippet':self.snippet,
+                'payload':{'headers':[
+                    {'name':'From','value':f'sender{index % self.senders}@example.com'},
+                    {'name':'Subject','value':f'subject {index % self.subjects}'},
+                ]},
+            }
+
+        return FakeRequest(self.upstream,'messages.get',response)
+
+    def _batch_modify(self,userId,body):
+        return FakeRequest(self.upstream,'messages.batchModify',lambda:{})
+
+    def _modify(self,userId,id,body):
+        return FakeRequest(self.upstream,'messages.modify',lambda:{'id':id})
+
+    def _send(self,userId,body,media_body=None):
+        return FakeRequest(self.upstream,'messages.send',lambda:{'id':'sent'})
+
+    def _labels_list(self,userId):
+        return FakeRequest(self.upstream,'labels.list',lambda:{'labels':[{'id':label_id,'name':name} for label_id,name in list(self.labels_by_id.items())]})
+
+    def _labels_create(self,userId,body):
+        def response():
+            with self._lock:
+                label_id = f'Label_{len(self.labels_by_id)}'
+                self.labels_by_id[label_id] = body['name']
+            return {'id':label_id,'name':body['name']}
+
+        return FakeRequest(self.upstream,'labels.create',response)
+
+    def _labels_delete(self,userId,id):
+        def response():
+            with self._lock:
+                self.labels_by_id.pop(id,None)
+            return ''
+
+        return FakeRequest(self.upstream,'labels.delete',response)
+
+class FakeCalendar:
+    def __init__(self,upstream):
+        self.upstream = upstream
+
+    def events(self):
+        return SimpleNamespace(insert=self._insert,get=self._get)
+
+    def new_batch_http_request(self,callback=None):
+        return FakeBatch(self.upstream,callback)
+
+    def _insert(self,calendarId,body,conferenceDataVersion=0):
+        request_id = body.get('conferenceData',{}).get('createRequest',{}).get('requestId','')
+        return FakeRequest(self.upstream,'events.insert',lambda:{'id':request_id,'hangoutLink':f'https://meet.google.com/{request_id[:10]}'})
+
+    def _get(self,calendarId,eventId):
+        return FakeRequest(self.upstream,'events.get',lambda:{'id':eventId,'hangoutLink':f'https://meet.google.com/{eventId[:10]}'})
+
+class FakeStructuredLLM:
+    # answers with the scenario's canned object for the requested schema
+    def __init__(self,upstream,schema,answers):
+        self.upstream = upstream
+        self.schema = schema
+        self.answers = answers
+
+    def invoke(self,input):
+        self.upstream.call(self.schema.__name__)
+        return self.answers[self.schema]
+
+    async def ainvoke(self,input):
+        return self.invoke(input)
+
+class FakeTool:
+    def __init__(self,upstream,answer):
+        self.upstream = upstream
+        self.answer = answer
+
+    def invoke(self,query):
+        self.upstream.call('run')
+        return self.answer
+
+class FakeTranscriptions:
+    # Whisper latency grows with the uploaded bytes on top of the fixed round trip
+    def __init__(self,upstream,seconds_per_mb,words):
+        self.upstream = upstream
+        self.seconds_per_mb = seconds_per_mb
+        self.words = words
+
+    def create(self,file,**kwargs):
+        size = len(file[1].read()) if hasattr(file[1],'read') else len(file[1])
+        self.upstream.call('transcriptions.create')
+        time.sleep(size/(1024*1024)*self.seconds_per_mb)
+        return SimpleNamespace(text=' '.join(random.choice(('yes','no','budget','timeline','phase')) for _ in range(self.words)))
+
+"""***Scenarios***"""
+
+def scenario_answers(args,route):
+    Intent,Email,Meetings,Criteria,File = (main_workflow.Intent,main_workflow.Email,main_workflow.Meetings,main_workflow.Criteria,main_workflow.File)
+
+    intents = {
+        'send_mail':Intent(route='send_mail',sender='me@example.com',receiver='you@example.com',subject='benchmark',message='hello',attachment=''),
+        'sort_mail':Intent(route='sort_mail',criteria='sender',remove_labels=False),
+        'remove_labels':Intent(route='sort_mail',criteria='sender',remove_labels=True),
+        'schedule_meeting':Intent(
+            route='schedule_meeting',
+            meetings=[
+                {'start':(datetime(2025,1,26,9)+timedelta(minutes=30*index)).isoformat(),'participants':[f'new{index}@example.com','b@example.com']}
+                for index in range(args.meetings)
+            ]
+        ),
+        'web_search':Intent(route='web_search',search_query='benchmark query'),
+        'transcribe':Intent(route='transcribe',file_path=args.audio_path),
+    }
+
+    return {
+        Intent:intents[route],
+        Email:Email(**{field:getattr(intents['send_mail'],field) for field in Email.model_fields}),
+        Meetings:Meetings(meetings=intents['schedule_meeting'].meetings),
+        Criteria:Criteria(criteria='sender'),
+        File:File(file_path=args.audio_path),
+    }
+
+@contextmanager
+def stand_ins(args,route,calls):
+    '''
+    Swaps the upstream clients of main_workflow for the stand-ins for the duration of a scenario.
+    '''
+    latency = lambda name:getattr(args,f'{name}_ms')/1000
+
+    groq = Upstream('groq',latency('groq'),calls)
+    whisper = Upstream('whisper',latency('whisper'),calls)
+    gmail = FakeGmail(Upstream('gmail',latency('gmail'),calls),args.mailbox_size,snippet_bytes=args.snippet_bytes,new_mail=args.new_mail)
+    calendar = FakeCalendar(Upstream('calendar',latency('calendar'),calls))
+    serpapi = FakeTool(Upstream('serpapi',latency('serpapi'),calls),'x'*args.answer_bytes)
+    wikipedia = FakeTool(Upstream('wikipedia',latency('wikipedia'),calls),'Page: benchmark\nSummary: '+'x'*args.answer_bytes)
+    answers = scenario_answers(args,route)
+    cache_directory = tempfile.mkdtemp()
+    cursors = main_workflow.HistoryCursors(':memory:')
+    store = main_workflow.MailStore(':memory:')
+
+    patches = {
+        'get_structured_llm':lambda schema:FakeStructuredLLM(groq,schema,answers),
+        'get_prompt_chain':lambda template,schema:FakeStructuredLLM(groq,schema,answers),
+        'get_tools':lambda:[serpapi],
+        'get_wiki_tool':lambda:wikipedia,
+        'get_search_cache':lambda:main_workflow.SearchCache(max_size=0),
+        'authenticate_user_for_gmail':lambda:SimpleNamespace(account='gmail'),
+        'authenticate_user_for_calender':lambda:SimpleNamespace(account='calendar'),
+        'get_service':lambda api,version,credentials:gmail if api == 'gmail' else calendar,
+        'get_groq_client':lambda:SimpleNamespace(audio=SimpleNamespace(transcriptions=FakeTranscriptions(whisper,args.whisper_seconds_per_mb,args.words_per_chunk))),
+        # every run transcribes from scratch
+        'get_transcription_cache':lambda:main_workflow.TranscriptionCache(cache_directory,max_bytes=0),
+        'audio_duration':lambda file_path:args.audio_minutes*60,
+        'can_compress_audio':lambda:False,
+        'cut_segment':lambda *arguments:fake_cut_segment(args,*arguments),
+        # without --incremental every sort is a full scan, with it only the first run of the scenario is
+        'SORT_INCREMENTAL':args.incremental,
+        'SORT_PIPELINE':not args.no_pipeline,
+        'get_history_cursors':lambda:cursors,
+        # the mirror starts empty for every scenario, later runs of it read the metadata locally
+        'get_mail_store':lambda:store,
+    }
+
+    if not args.respect_limits:
+        patches['rate_limiters'] = {name:main_workflow.TokenBucket(1e9,1e9) for name in main_workflow.rate_limiters}
+
+    originals = {name:getattr(main_workflow,name) for name in patches}
+
+    for name,value in patches.items():
+        setattr(main_workflow,name,value)
+
+    main_workflow.metrics = main_workflow.Metrics()
+
+    try:
+        yield
+    finally:
+        for name,value in originals.items():
+            setattr(main_workflow,name,value)
+
+def fake_cut_segment(args,file_path,start,length,directory,index,compress=False):
+    # a segment of the synthetic recording, sized like the real cut would be
+    segment_path = os.path.join(directory,f'segment_{index}.wav')
+    bytes_per_second = os.path.getsize(file_path)/(args.audio_minutes*60)
+
+    with open(segment_path,'wb') as segment, open(file_path,'rb') as audio:
+        audio.seek(int(start*bytes_per_second))
+        segment.write(audio.read(int(length*bytes_per_second)))
+
+    return segment_path
+
+SCENARIOS = {
+    'send_mail':'send a mail to you@example.com saying hello',
+    'sort_mail':'sort my emails by sender',
+    'remove_labels':'sort my emails by sender and remove the labels',
+    'schedule_meeting':'schedule a meeting on 26 January 2025 at 18:00 with a@example.com and b@example.com',
+    'web_search':'what is langgraph',
+    'transcribe':'transcribe the recording',
+}
+
+def percentile(values,q):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = min(len(values)-1,max(0,int(round(q/100*(len(values)-1)))))
+
+    return values[index]
+
+def run_scenario(args,route):
+    calls = Counter()
+
+    # the local classifier would skip the router call for most of these, it is left out so every run pays the same routing
+    classifiers = main_workflow.intent_classifiers[:]
+    main_workflow.intent_classifiers[:] = []
+
+    try:
+        with stand_ins(args,route,calls):
+            graph = main_workflow.build_workflow().compile()
+
+            def run(_):
+                state = graph.invoke({'question':[('user',SCENARIOS[route])]})
+                return state.get('trace_id')
+
+            started = time.perf_counter()
+
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                trace_ids = list(pool.map(run,range(args.iterations)))
+
+            elapsed = time.perf_counter()-started
+            traces = [main_workflow.get_trace(trace_id) for trace_id in trace_ids if trace_id]
+    finally:
+        main_workflow.intent_classifiers[:] = classifiers
+
+    steps = {}
+    for trace in traces:
+        totals = Counter()
+        for span in trace['spans']:
+            totals[span['name']] += span['seconds']
+        for name,seconds in totals.items():
+            steps.setdefault(name,[]).append(seconds)
+
+    return {
+        'scenario':route,
+        'iterations':args.iterations,
+        'concurrency':args.concurrency,
+        'seconds':elapsed,
+        'throughput_per_second':args.iterations/elapsed if elapsed else 0.0,
+        'steps':{
+            name:{'p50':percentile(values,50),'p95':percentile(values,95),'p99':percentile(values,99)}
+            for name,values in steps.items()
+        },
+        'api_calls':{name:count/args.iterations for name,count in sorted(calls.items())},
+    }
+
+def print_report(result):
+    print(f"\n== {result['scenario']} : {result['iterations']} runs, concurrency {result['concurrency']}, "
+          f"{result['seconds']:.2f}s, {result['throughput_per_second']:.2f} runs/s")
+
+    print(f"{'step':<24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name,stats in result['steps'].items():
+        print(f"{name:<24}{stats['p50']*1000:>10.1f}{stats['p95']*1000:>10.1f}{stats['p99']*1000:>10.1f}")
+
+    print(f"{'api call':<40}{'per run':>10}")
+    for name,count in result['api_calls'].items():
+        print(f"{name:<40}{count:>10.1f}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the workflow graph')
+    parser.add_argument('--scenario',choices=[*SCENARIOS,'all'],default='all')
+    parser.add_argument('--iterations',type=int,default=5)
+    parser.add_argument('--concurrency',type=int,default=1)
+    parser.add_argument('--mailbox-size',type=int,default=10000)
+    parser.add_argument('--snippet-bytes',type=int,default=200)
+    parser.add_argument('--incremental',action='store_true',help='sort from the history cursor after the first run')
+    parser.add_argument('--new-mail',type=int,default=100,help='messages added between two incremental sorts')
+    parser.add_argument('--no-pipeline',action='store_true',help='fetch the whole mailbox before labeling instead of page by page')
+    parser.add_argument('--answer-bytes',type=int,default=2000)
+    parser.add_argument('--meetings',type=int,default=1,help='meetings scheduled by one schedule_meeting request')
+    parser.add_argument('--audio-minutes',type=float,default=60)
+    parser.add_argument('--audio-bytes-per-second',type=int,default=16000)
+    parser.add_argument('--words-per-chunk',type=int,default=1500)
+    parser.add_argument('--whisper-seconds-per-mb',type=float,default=0.05)
+    parser.add_argument('--groq-ms',type=float,default=300)
+    parser.add_argument('--whisper-ms',type=float,default=500)
+    parser.add_argument('--gmail-ms',type=float,default=80)
+    parser.add_argument('--calendar-ms',type=float,default=120)
+    parser.add_argument('--serpapi-ms',type=float,default=900)
+    parser.add_argument('--wikipedia-ms',type=float,default=400)
+    parser.add_argument('--respect-limits',action='store_true',help='keep the configured rate limiters instead of disabling them')
+    parser.add_argument('--json',action='store_true',help='print the results as json')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    routes = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+
+    with tempfile.TemporaryDirectory() as directory:
+        # a synthetic recording of the requested length, only its size matters to the stand-ins
+        args.audio_path = os.path.join(directory,'recording.wav')
+        with open(args.audio_path,'wb') as audio:
+            audio.truncate(int(args.audio_minutes*60*args.audio_bytes_per_second))
+
+        results = [run_scenario(args,route) for route in routes]
+
+    if args.json:
+        print(json.dumps(results,indent=2))
+    else:
+        for result in results:
+            print_report(result)
+
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,77 @@
-from main_workflow import graph
+import asyncio
+from typing import Any,Literal,Optional
+from pydantic import BaseModel,Field,field_validator
+from main_workflow import get_graph,ainvoke_graph,thread_config
 
-def get_mail_output_from_graph(query,attachment_file=''):
-    events = graph.stream({'question':[('user',f'''{query}, attachment : {attachment_file}''')]},stream_mode='values')
+BATCH_CONCURRENCY = 16
+
+class GraphRequest(BaseModel):
+    kind : Literal['mail','audio','labels','remove','web','meeting'] = Field(description='which helper the request stands for')
+    query : str = Field(description='the query of the user')
+    attachment_file : str = Field(default='',description='mail : path of the attachment')
+    audio_file : str = Field(default='',description='audio : path of the recording')
+    criteria : str = Field(default='sender',description="labels : 'sender' or 'subject'")
+    intent : Optional[dict] = Field(default=None,description='an already classified intent, see main_workflow.Intent')
+    meetings : Optional[list] = Field(default=None,description="meeting : a structured list of {'start','participants','summary'}, scheduled without extraction")
+    thread_id : Optional[str] = Field(default=None,description='conversation whose checkpointed state the request continues, e.g. the labels of an earlier sort')
+
+    @field_validator('intent',mode='before')
+    @classmethod
+    def dump_intent(cls,intent):
+        if hasattr(intent,'model_dump'):
+            return intent.model_dump(mode='json')
+        return intent
+
+class BatchResult(BaseModel):
+    index : int
+    output : Any = None
+    error : Optional[str] = None
+
+def build_inputs(question,intent=None,**arguments):
+    # passing an already classified intent skips the routing call inside the graph
+    # the intent is always set, a checkpointed conversation would otherwise keep the previous request's one
+    inputs = {'question':[('user',question)],'intent':None}
+
+    if intent is not None:
+        if hasattr(intent,'model_dump'):
+            intent = intent.model_dump(mode='json')
+
+        intent = dict(intent)
+        intent.update({key:value for key,value in arguments.items() if value})
+
+        inputs['intent'] = intent
+
+    return inputs
+
+# the route each kind stands for, a request without an intent is routed by its kind instead of classified
+KIND_ROUTES = {
+    'mail':'send_mail',
+    'audio':'transcribe',
+    'labels':'sort_mail',
+    'remove':'remove_labels',
+    'web':'web_search',
+    'meeting':'schedule_meeting',
+}
+
+def request_inputs(request):
+    intent = request.intent or {'route':KIND_ROUTES[request.kind]}
+
+    if request.kind == 'mail':
+        return build_inputs(f'''{request.query}, attachment : {request.attachment_file}''',intent,attachment=request.attachment_file)
+    elif request.kind == 'audio':
+        return build_inputs(f'''{request.query} , file path : {request.audio_file}''',intent,file_path=request.audio_file)
+    elif request.kind == 'meeting':
+        return build_inputs(request.query,intent,meetings=request.meetings)
+    elif request.kind == 'labels':
+        return build_inputs(f'''{request.query}, criteria :{request.criteria}''',intent,criteria=request.criteria)
+    else:
+        return build_inputs(request.query,intent)
+
+def request_config(request):
+    return thread_config(request.thread_id)
+
+def get_mail_output_from_graph(query,attachment_file='',intent=None):
+    events = get_graph().stream(request_inputs(GraphRequest(kind='mail',query=query,attachment_file=attachment_file,intent=intent)),stream_mode='values')
 
     try :
         for event in events:
@@ -10,34 +80,112 @@ def get_mail_output_from_graph(query,attachment_file=''):
     except Exception:
         return False
 
-def get_audio_output_from_graph(audio_file,query):
-    events = graph.stream({'question':[('user',f'''{query} , file path : {audio_file}''')]},stream_mode='values')
+def get_audio_output_from_graph(audio_file,query,intent=None):
+    events = get_graph().stream(request_inputs(GraphRequest(kind='audio',query=query,audio_file=audio_file,intent=intent)),stream_mode='values')
 
     for event in events:
         res = event.get('messages')
     
     return res
 
-def get_labels_output_from_graph(query,criteria='sender'):
-    events = graph.stream({'question':[('user',f'''{query}, criteria :{criteria}''')]},stream_mode='values')
+def get_labels_output_from_graph(query,criteria='sender',intent=None):
+    events = get_graph().stream(request_inputs(GraphRequest(kind='labels',query=query,criteria=criteria,intent=intent)),stream_mode='values')
 
     for event in events:
         res = event.get('messages')
     
     return res
 
-def get_web_output_from_graph(query):
-    events = graph.stream({'question':query},stream_mode='values')
+def get_web_output_from_graph(query,intent=None):
+    events = get_graph().stream(request_inputs(GraphRequest(kind='web',query=query,intent=intent)),stream_mode='values')
 
     for event in events:
         res = event.get('messages')
     
     return res
 
-def get_output_from_graph(query):
-    events = graph.stream({'question':[('user',query)]},stream_mode='values')
+def get_output_from_graph(query,intent=None):
+    # any query, the graph classifies it unless an intent is passed
+    events = get_graph().stream(build_inputs(query,intent),stream_mode='values')
 
     for event in events:
         res = event.get('messages')
     
-    return res
\ No newline at end of file
+    return res
+
+"""***Progress***"""
+
+# what each finished node means for the user, keyed by node name
+PROGRESS_MESSAGES = {
+    'Router':lambda update:f"route chosen : {update['intent']['route']}",
+    'Authenticator_1':lambda update:'gmail authentication done',
+    'Authenticator_2':lambda update:'calendar authentication done',
+    'Sort Mail':lambda update:'emails sorted',
+    'Remove':lambda update:'labels removed',
+    'Mail Sender':lambda update:'mail sent',
+    'Meeting':lambda update:'meeting scheduled',
+    'Extract Audio':lambda update:'transcription done',
+    'Web':lambda update:'web search done',
+}
+
+def stream_progress(request):
+    '''
+    Runs the request and yields ('progress',message) after every node and custom node event,
+    ('partial',text) for the answer of each source of a merged web search as it returns and finally ('result',messages).
+    '''
+    res = None
+
+    for mode,chunk in get_graph(request.thread_id is not None).stream(request_inputs(request),request_config(request),stream_mode=['updates','custom']):
+        if mode == 'custom':
+            if 'message' in chunk:
+                yield 'progress',chunk['message']
+            if 'text' in chunk:
+                yield 'partial',chunk['text']
+            continue
+
+        for node,update in chunk.items():
+            update = update or {}
+
+            if node in PROGRESS_MESSAGES:
+                yield 'progress',PROGRESS_MESSAGES[node](update)
+
+            if 'messages' in update:
+                res = update['messages']
+
+    yield 'result',res
+
+"""***Batch***"""
+
+async def stream_batch(requests,concurrency=BATCH_CONCURRENCY):
+    # yields a BatchResult per request as soon as it finishes, at most `concurrency` graphs run at once
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index,request):
+        async with semaphore:
+            try:
+                state = await ainvoke_graph(request_inputs(request),request_config(request))
+                return BatchResult(index=index,output=state.get('messages'))
+            except Exception as e:
+                return BatchResult(index=index,error=f'{type(e).__name__}: {e}')
+
+    tasks = [asyncio.ensure_future(run(index,request)) for index,request in enumerate(requests)]
+
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def arun_batch(requests,concurrency=BATCH_CONCURRENCY):
+    requests = list(requests)
+    results = [None]*len(requests)
+
+    async for result in stream_batch(requests,concurrency):
+        results[result.index] = result
+
+    return results
+
+def run_batch(requests,concurrency=BATCH_CONCURRENCY):
+    # results come back in input order, a failed request carries its error instead of an output
+    return asyncio.run(arun_batch(requests,concurrency))
\ No newline at end of file
@@ -1,28 +1,42 @@
+import time
+
+_import_started = time.perf_counter()
+
 import os
+import re
+import asyncio
+import random
+import threading
+import contextvars
+import inspect
+from functools import lru_cache,wraps
 from dotenv import load_dotenv
-from langgraph.graph import StateGraph,START,END
-from typing import Annotated,Literal
+from typing import Literal
 from typing_extensions import TypedDict,List,Optional
-from langgraph.graph.message import add_messages
-from pydantic import BaseModel,Field
+from pydantic import BaseModel,Field,ValidationError
 import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from langchain_community.utilities import WikipediaAPIWrapper,SerpAPIWrapper
-from langchain_community.tools import WikipediaQueryRun
-from langchain.agents import Tool
+import tempfile
+import sqlite3
+import shutil
+import hashlib
+import json
+import subprocess
+import queue
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 import mimetypes
 from email.mime.multipart import MIMEMultipart
 from email import encoders
+from email.message import Message
+import uuid
 import base64
-from datetime import datetime,timedelta
-from groq import Groq
-from langchain_core.documents import Document
-from langchain_core.prompts import ChatPromptTemplate
+from datetime import datetime,timedelta,timezone
 
+# LLM clients, LangGraph, the Google client libraries and the web tools are only imported
+# and constructed the first time they are used, importing this module makes no network calls.
 
 load_dotenv()
 
@@ -33,77 +47,974 @@ serpapi_api_key = os.getenv('SERPAPI_API_KEY')
 
 """***LLM***"""
 
-from langchain_groq import ChatGroq
+@lru_cache(maxsize=None)
+def get_llm():
+    from langchain_groq import ChatGroq
+
+    # retries are left to call_with_limits, a 429 retried inside the SDK would bypass the shared limiter
+    return ChatGroq(model='llama-3.3-70b-versatile',api_key=groq_api_key,max_retries=0,callbacks=[get_usage_handler()])
+
+@lru_cache(maxsize=None)
+def get_structured_llm(schema):
+    return get_llm().with_structured_output(schema)
+
+@lru_cache(maxsize=None)
+def get_prompt_chain(template,schema):
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_template(template)|get_structured_llm(schema)
+
+
+"""***Instrumentation***"""
+
+# seconds, shared by the node, edge and upstream call histograms
+LATENCY_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,float('inf'))
+MAX_TRACES = int(os.getenv('MAX_TRACES','1000'))
+
+class Histogram:
+    def __init__(self,buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self,value):
+        self.sum += value
+        self.count += 1
+        for i,bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+class Metrics:
+    '''
+    Per-request traces and process wide aggregates of node/edge wall time, upstream calls and LLM tokens.
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self,name,labels,value):
+        with self._lock:
+            self.histograms.setdefault((name,labels),Histogram()).observe(value)
+
+    def increment(self,name,labels,value=1):
+        with self._lock:
+            self.counters[(name,labels)] = self.counters.get((name,labels),0) + value
+
+    def new_trace(self):
+        trace = {'id':uuid.uuid4().hex,'started':time.time(),'spans':[],'calls':[],'tokens':{'input':0,'output':0}}
+
+        with self._lock:
+            self.traces[trace['id']] = trace
+            while len(self.traces) > MAX_TRACES:
+                self.traces.popitem(last=False)
+
+        return trace
+
+    def get_trace(self,trace_id):
+        with self._lock:
+            return self.traces.get(trace_id)
+
+    def render(self):
+        # prometheus text exposition format
+        lines = []
+
+        def format_labels(labels,extra=()):
+            pairs = list(labels)+list(extra)
+            return '{'+','.join(f'{key}="{value}"' for key,value in pairs)+'}' if pairs else ''
+
+        with self._lock:
+            for name in sorted({name for name,_ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (metric,labels),histogram in self.histograms.items():
+                    if metric != name:
+                        continue
+                    for bound,count in zip(histogram.buckets,histogram.counts):
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{format_labels(labels,[('le',le)])} {count}")
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+            for name in sorted({name for name,_ in self.counters}):
+                lines.append(f'# TYPE {name} counter')
+                for (metric,labels),value in self.counters.items():
+                    if metric == name:
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+
+        return '\n'.join(lines)+'\n'
+
+metrics = Metrics()
+
+# the trace of the request the current node belongs to
+current_trace = contextvars.ContextVar('current_trace',default=None)
+
+def record_call(upstream,seconds,status='ok'):
+    metrics.observe('agent_upstream_call_seconds',(('upstream',upstream),),seconds)
+    metrics.increment('agent_upstream_calls_total',(('upstream',upstream),('status',str(status))))
+
+    trace = current_trace.get()
+    if trace is not None:
+        trace['calls'].append({'upstream':upstream,'seconds':seconds,'status':status})
+
+def record_tokens(input_tokens,output_tokens):
+    metrics.increment('agent_llm_tokens_total',(('type','input'),),input_tokens)
+    metrics.increment('agent_llm_tokens_total',(('type','output'),),output_tokens)
+
+    trace = current_trace.get()
+    if trace is not None:
+        trace['tokens']['input'] += input_tokens
+        trace['tokens']['output'] += output_tokens
+
+def timed(upstream,function,*args,**kwargs):
+    started = time.perf_counter()
+
+    try:
+        result = function(*args,**kwargs)
+    except Exception as error:
+        record_call(upstream,time.perf_counter()-started,retry_status(error) or type(error).__name__)
+        raise
+
+    record_call(upstream,time.perf_counter()-started)
+    return result
+
+async def atimed(upstream,function,*args,**kwargs):
+    started = time.perf_counter()
+
+    try:
+        result = await function(*args,**kwargs)
+    except Exception as error:
+        record_call(upstream,time.perf_counter()-started,retry_status(error) or type(error).__name__)
+        raise
+
+    record_call(upstream,time.perf_counter()-started)
+    return result
+
+@lru_cache(maxsize=None)
+def get_usage_handler():
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class UsageHandler(BaseCallbackHandler):
+        def on_llm_end(self,response,**kwargs):
+            usage = (response.llm_output or {}).get('token_usage') or {}
+            record_tokens(usage.get('prompt_tokens',0),usage.get('completion_tokens',0))
+
+    return UsageHandler()
+
+def instrument(name,function,kind='node',opens_trace=False):
+    '''
+    Wraps a node or conditional-edge function so that its wall time lands in the request's trace
+    and in the histograms. The first node of a run opens the trace and stores its id in the state.
+    '''
+    def enter(state):
+        trace = None if opens_trace or not state.get('trace_id') else metrics.get_trace(state['trace_id'])
+
+        if trace is None:
+            trace = metrics.new_trace()
+
+        return trace,current_trace.set(trace),time.perf_counter()
+
+    def leave(trace,token,started,result):
+        seconds = time.perf_counter()-started
+        current_trace.reset(token)
+
+        trace['spans'].append({'name':name,'kind':kind,'seconds':seconds})
+        metrics.observe('agent_step_seconds',(('step',name),('kind',kind)),seconds)
+
+        if kind == 'node' and isinstance(result,dict):
+            result = {**result,'trace_id':trace['id']}
+
+        return result
+
+    if inspect.iscoroutinefunction(function):
+        @wraps(function)
+        async def wrapper(state):
+            trace,token,started = enter(state)
+            return leave(trace,token,started,await function(state))
+    else:
+        @wraps(function)
+        def wrapper(state):
+            trace,token,started = enter(state)
+            return leave(trace,token,started,function(state))
+
+    return wrapper
+
+def render_metrics():
+    return metrics.render()
+
+def get_trace(trace_id):
+    return metrics.get_trace(trace_id)
+
+def start_metrics_server(port=int(os.getenv('METRICS_PORT','9464'))):
+    # serves render_metrics() on /metrics for a scraper, in a daemon thread
+    from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render_metrics().encode('utf-8')
+            self.send_response(200 if self.path == '/metrics' else 404)
+            self.send_header('Content-Type','text/plain; version=0.0.4')
+            self.end_headers()
+            if self.path == '/metrics':
+                self.wfile.write(body)
+
+        def log_message(self,*args):
+            pass
+
+    server = ThreadingHTTPServer(('',port),MetricsHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+
+    return server
+
+
+"""***Rate Limiting***"""
+
+# requests per second and burst size per upstream, shared by every thread and coroutine of the process
+RATE_LIMITS = {
+    'groq':(float(os.getenv('GROQ_REQUESTS_PER_MINUTE','30'))/60,int(os.getenv('GROQ_BURST','5'))),
+    'whisper':(float(os.getenv('WHISPER_REQUESTS_PER_MINUTE','20'))/60,int(os.getenv('WHISPER_BURST','4'))),
+    'gmail':(float(os.getenv('GMAIL_QUOTA_UNITS_PER_SECOND','250')),int(os.getenv('GMAIL_QUOTA_BURST','250'))),
+    'calendar':(float(os.getenv('CALENDAR_REQUESTS_PER_SECOND','10')),int(os.getenv('CALENDAR_BURST','10'))),
+}
+
+# Gmail charges quota units per method instead of per request
+GMAIL_QUOTA_UNITS = {
+    'messages.list':5,
+    'messages.get':5,
+    'messages.send':100,
+    'messages.modify':5,
+    'messages.batchModify':50,
+    'labels.list':1,
+    'labels.create':5,
+    'labels.delete':5,
+    'history.list':2,
+    'getProfile':1,
+}
+
+RETRY_STATUSES = {429,503}
+MAX_RETRIES = int(os.getenv('MAX_RETRIES','5'))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+
+class TokenBucket:
+    '''
+    Token bucket whose rate is halved whenever the upstream answers 429/503 and
+    creeps back to the configured rate on every success.
+    '''
+    def __init__(self,rate,capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self,cost):
+        # takes the tokens if they are there, otherwise returns how long to wait for them
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,self.tokens+(now-self.updated)*self.rate)
+            self.updated = now
+
+            cost = min(cost,self.capacity)
+
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0
+
+            return (cost-self.tokens)/self.rate
 
-llm = ChatGroq(model='llama-3.3-70b-versatile',api_key=groq_api_key)
+    def acquire(self,cost=1):
+        while (delay := self._reserve(cost)) > 0:
+            time.sleep(delay)
+
+    async def aacquire(self,cost=1):
+        while (delay := self._reserve(cost)) > 0:
+            await asyncio.sleep(delay)
+
+    def back_off(self):
+        with self._lock:
+            self.rate = max(self.rate/2,self.max_rate/10)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.rate*1.1,self.max_rate)
+
+rate_limiters = {upstream:TokenBucket(rate,capacity) for upstream,(rate,capacity) in RATE_LIMITS.items()}
+
+def quota_cost(upstream,method=None):
+    if upstream == 'gmail':
+        return GMAIL_QUOTA_UNITS.get(method,5)
+    return 1
+
+def retry_status(error):
+    # googleapiclient's HttpError carries resp.status, the groq client errors carry status_code
+    status = getattr(getattr(error,'resp',None),'status',None) or getattr(error,'status_code',None)
+
+    try:
+        return int(status)
+    except (TypeError,ValueError):
+        return None
+
+def backoff_delay(attempt):
+    # full jitter, concurrent callers that were throttled together do not retry together
+    return random.uniform(0,min(BACKOFF_MAX_SECONDS,BACKOFF_BASE_SECONDS*2**attempt))
+
+def call_with_limits(upstream,function,*args,cost=1,**kwargs):
+    limiter = rate_limiters[upstream]
+
+    for attempt in range(MAX_RETRIES+1):
+        limiter.acquire(cost)
+
+        try:
+            result = timed(upstream,function,*args,**kwargs)
+        except Exception as error:
+            if retry_status(error) not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                raise
+            limiter.back_off()
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        limiter.recover()
+        return result
+
+async def acall_with_limits(upstream,function,*args,cost=1,**kwargs):
+    limiter = rate_limiters[upstream]
+
+    for attempt in range(MAX_RETRIES+1):
+        await limiter.aacquire(cost)
+
+        try:
+            result = await atimed(upstream,function,*args,**kwargs)
+        except Exception as error:
+            if retry_status(error) not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                raise
+            limiter.back_off()
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+
+        limiter.recover()
+        return result
+
+def invoke_llm(runnable,input):
+    return call_with_limits('groq',runnable.invoke,input)
+
+async def ainvoke_llm(runnable,input):
+    return await acall_with_limits('groq',runnable.ainvoke,input)
+
+
+"""***Progress***"""
+
+def emit_progress(**event):
+    # custom stream event for callers streaming with stream_mode 'custom', a no-op outside a graph run
+    try:
+        from langgraph.config import get_stream_writer
+
+        writer = get_stream_writer()
+    except Exception:
+        return
+
+    writer(event)
 
 
 """***WEB TOOLS***"""
 
-wiki_wrapper = WikipediaAPIWrapper(top_k_results=1)
-wiki_tool = WikipediaQueryRun(api_wrapper=wiki_wrapper)
+@lru_cache(maxsize=None)
+def get_wiki_tool():
+    from langchain_community.utilities import WikipediaAPIWrapper
+    from langchain_community.tools import WikipediaQueryRun
+
+    wiki_wrapper = WikipediaAPIWrapper(top_k_results=1)
 
-api_wrapper = SerpAPIWrapper(serpapi_api_key = serpapi_api_key)
+    return WikipediaQueryRun(api_wrapper=wiki_wrapper)
 
-tools = [
-    Tool(
-        name="Search",
-        func=api_wrapper.run,
-        description="Search for anything on the web"
-    ),
-]
+@lru_cache(maxsize=None)
+def get_tools():
+    from langchain_community.utilities import SerpAPIWrapper
+    from langchain.agents import Tool
+
+    api_wrapper = SerpAPIWrapper(serpapi_api_key = serpapi_api_key)
+
+    return [
+        Tool(
+            name="Search",
+            func=api_wrapper.run,
+            description="Search for anything on the web"
+        ),
+    ]
+
+"""*Search Cache*"""
+
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL','3600'))               # seconds
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE','1024'))               # entries kept in memory
+SEARCH_CACHE_DISK_SIZE = int(os.getenv('SEARCH_CACHE_DISK_SIZE','100000'))   # entries kept on disk
+SEARCH_CACHE_PATH = os.getenv('SEARCH_CACHE_PATH')                           # sqlite file, memory only when unset
+SEARCH_CACHE_EVICT_EVERY = int(os.getenv('SEARCH_CACHE_EVICT_EVERY','256'))  # disk writes between two evictions
+
+def normalize_query(query):
+    # case, spacing and trailing ?.! differences map to the same entry, other punctuation is meaningful (C++ / C#)
+    return ' '.join(query.lower().split()).rstrip('?.! ')
+
+class SearchCache:
+    '''
+    TTL + LRU cache of web search results keyed by the normalized query,
+    optionally backed by a sqlite file so that entries survive restarts.
+    '''
+    def __init__(self,ttl=SEARCH_CACHE_TTL,max_size=SEARCH_CACHE_SIZE,path=None,max_disk_size=SEARCH_CACHE_DISK_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self.stats = {'hits':0,'misses':0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = None
+
+        if path:
+            self._db = sqlite3.connect(path,check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS search_cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS search_cache_expires_at ON search_cache (expires_at)')
+            self._db.commit()
+
+    def get(self,query):
+        key = normalize_query(query)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None and self._db is not None:
+                row = self._db.execute('SELECT expires_at,value FROM search_cache WHERE key = ?',(key,)).fetchone()
+                if row is not None:
+                    entry = tuple(row)
+                    self._remember(key,entry)
+
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+
+            if entry is not None:
+                self._forget(key)
+
+            self.stats['misses'] += 1
+            return None
+
+    def set(self,query,value):
+        key = normalize_query(query)
+        entry = (time.time()+self.ttl,value)
+
+        with self._lock:
+            self._remember(key,entry)
+
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO search_cache (key,value,expires_at) VALUES (?,?,?)',(key,value,entry[0]))
+
+                self._writes += 1
+                if self._writes % SEARCH_CACHE_EVICT_EVERY == 0:
+                    self._evict()
+
+                self._db.commit()
+
+    def _evict(self):
+        # run every SEARCH_CACHE_EVICT_EVERY writes, the table may exceed max_disk_size by that much in between
+        self._db.execute('DELETE FROM search_cache WHERE expires_at <= ?',(time.time(),))
+
+        excess = self._db.execute('SELECT COUNT(*) FROM search_cache').fetchone()[0] - self.max_disk_size
+        if excess > 0:
+            self._db.execute(
+                'DELETE FROM search_cache WHERE key IN (SELECT key FROM search_cache ORDER BY expires_at LIMIT ?)',
+                (excess,)
+            )
+
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+
+        return self.stats['hits'] / total if total else 0.0
+
+    def _remember(self,key,entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _forget(self,key):
+        self._entries.pop(key,None)
+
+        if self._db is not None:
+            self._db.execute('DELETE FROM search_cache WHERE key = ?',(key,))
+            self._db.commit()
+
+@lru_cache(maxsize=None)
+def get_search_cache():
+    return SearchCache(path=SEARCH_CACHE_PATH)
+
+def search_serpapi(query):
+    cache = get_search_cache()
+
+    result = cache.get(query)
+
+    if result is None:
+        result = timed('serpapi',get_tools()[0].invoke,query)
+
+        # a miss or an empty answer may be temporary, only a good answer is kept for the whole TTL
+        if is_good_answer(result):
+            cache.set(query,result)
+
+    return result
+
+def search_wikipedia(query):
+    return timed('wikipedia',get_wiki_tool().invoke,query)
+
+"""*Search Fan-out*"""
+
+# 'primary' the first source's answer, the next ones only when it fails or times out,
+# 'first' good answer wins or 'merge' all answers within the deadlines
+WEB_SEARCH_POLICY = os.getenv('WEB_SEARCH_POLICY','primary')
+WEB_SEARCH_TIMEOUTS = {
+    'serpapi':float(os.getenv('SERPAPI_TIMEOUT','10')),
+    'wikipedia':float(os.getenv('WIKIPEDIA_TIMEOUT','5')),
+}
+WEB_SEARCH_DEADLINE = float(os.getenv('WEB_SEARCH_DEADLINE','10'))     # seconds for the whole node, from submission
+
+# queried concurrently, the order here is the order of preference and of the merged answer
+web_sources = {
+    'serpapi':search_serpapi,
+    'wikipedia':search_wikipedia,
+}
+
+NO_RESULT = 'No good search result found'
+
+def is_good_answer(result):
+    return isinstance(result,str) and result.strip() != '' and not result.startswith(('No good',NO_RESULT))
+
+@lru_cache(maxsize=None)
+def get_search_executor(name):
+    # one pool per source, calls abandoned past their deadline only hold workers of their own backend
+    return ThreadPoolExecutor(max_workers=int(os.getenv('WEB_SEARCH_WORKERS','8')),thread_name_prefix=f'web-search-{name}')
+
+def search_web(query,policy=None,timeouts=None,deadline=None):
+    policy = policy or WEB_SEARCH_POLICY
+    timeouts = {**WEB_SEARCH_TIMEOUTS,**(timeouts or {})}
+
+    # every deadline counts from submission, time spent queued behind other requests included,
+    # so the node never takes longer than the overall deadline whatever the load
+    submitted = time.monotonic()
+    deadline = submitted+(deadline or WEB_SEARCH_DEADLINE)
+    deadlines = {name:min(submitted+timeouts.get(name,max(timeouts.values())),deadline) for name in web_sources}
+
+    # each source runs in a copy of the caller's context so its call is recorded in the request's trace
+    futures = {get_search_executor(name).submit(contextvars.copy_context().run,search,query):name for name,search in web_sources.items()}
+
+    results = {}
+    finished = set()
+    pending = set(futures)
+
+    def answer():
+        # the answer the policy settles on with what has finished so far, None while it still has to wait
+        if policy == 'merge':
+            return None
+        for name in web_sources:
+            if name in results:
+                return results[name]
+            if name not in finished and policy == 'primary':
+                break
+        return None
+
+    while pending:
+        now = time.monotonic()
+
+        # a source past its deadline is given up on, a slow or queued backend does not hold the answer back
+        for future in [f for f in pending if deadlines[futures[f]] <= now]:
+            future.cancel()
+            pending.discard(future)
+            finished.add(futures[future])
+            print(f"{futures[future]} search timed out")
+
+        if not pending or answer() is not None:
+            break
+
+        timeout = min(deadlines[futures[f]] for f in pending)-now
+        done,pending = wait(pending,timeout=max(timeout,0),return_when=FIRST_COMPLETED)
+
+        for future in done:
+            name = futures[future]
+            finished.add(name)
+
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"{name} search failed : {e}")
+                continue
+
+            if is_good_answer(result):
+                results[name] = result
+
+                if policy == 'merge':
+                    emit_progress(message=f'{name} answered',text=result)
+
+    # an answer was settled on, the sources still queued are not run at all
+    for future in pending:
+        future.cancel()
+
+    if policy != 'merge':
+        result = answer()
+
+        if result is None:
+            return NO_RESULT
+
+        # the answer itself is the node's result, it is not sent ahead a second time
+        name = next(name for name in web_sources if results.get(name) is result)
+        emit_progress(message=f'{name} answered')
+
+        return result
+
+    if not results:
+        return NO_RESULT
+
+    if len(results) == 1:
+        return next(iter(results.values()))
+
+    return '\n\n'.join(f"{name} : {results[name]}" for name in web_sources if name in results)
 
 """***Google API Authentication***"""
 
 SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+GMAIL_SCOPES = ["https://www.googleapis.com/auth/gmail.send","https://www.googleapis.com/auth/gmail.modify"]
 
-def authenticate_user_for_calender():
-    creds = None
+CREDENTIAL_REFRESH_MARGIN = timedelta(minutes=5)
+
+class CredentialManager:
+    '''
+    Keeps the OAuth credentials of one account in memory, refreshes them in the background
+    shortly before they expire and persists refreshed tokens atomically to the file they are read from.
+    '''
+    def __init__(self,token_file,client_secrets_file,scopes,refresh_margin=CREDENTIAL_REFRESH_MARGIN):
+        self.token_file = token_file
+        self.client_secrets_file = client_secrets_file
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self._creds = None
+        self._lock = threading.Lock()
+        self._timer = None
+        self._scheduled = None
 
-    if os.path.exists('calendar_token.pickle'):
-        with open('calendar_token.pickle','rb') as token:
-            creds = pickle.load(token)
+    def get(self):
+        with self._lock:
+            creds = self._creds
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            if creds is None and os.path.exists(self.token_file):
+                with open(self.token_file,'rb') as token:
+                    creds = pickle.load(token)
 
+            if not creds or not creds.valid or self._expiring(creds):
+                creds = self._refresh_or_authorize(creds)
+                self._save(creds)
+
+            self._creds = creds
+            self._schedule_refresh(creds)
+
+            return creds
+
+    def _expiring(self,creds):
+        # google-auth keeps the expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+        return creds.expiry is not None and creds.expiry - self.refresh_margin <= now
+
+    def _refresh_or_authorize(self,creds):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+
+        if creds and creds.refresh_token:
+            timed('oauth',creds.refresh,Request())
         else:
             flow = InstalledAppFlow.from_client_secrets_file(
-                'calendar_credentials.json',
-                scopes=SCOPES
+                self.client_secrets_file,
+                scopes=self.scopes
             )
             creds = flow.run_local_server(port=0)
 
-        with open('calendar_token.pikle','wb') as token:
+        return creds
+
+    def _save(self,creds):
+        # writing to a temporary file next to the token and swapping it in, readers never see a half written pickle
+        directory = os.path.dirname(os.path.abspath(self.token_file))
+
+        with tempfile.NamedTemporaryFile('wb',dir=directory,delete=False) as token:
             pickle.dump(creds,token)
+            token.flush()
+            os.fsync(token.fileno())
+
+        os.replace(token.name,self.token_file)
+
+    def _schedule_refresh(self,creds):
+        # get() runs in every node needing the account, the timer only changes with the credentials or their expiry
+        if self._timer is not None and self._scheduled == (creds,creds.expiry):
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if creds.expiry is None or not creds.refresh_token:
+            return
+
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        delay = max((creds.expiry - self.refresh_margin - now).total_seconds(),0)
+
+        self._scheduled = (creds,creds.expiry)
+        self._timer = threading.Timer(delay,self._refresh_ahead)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_ahead(self):
+        from google.auth.transport.requests import Request
 
-    return creds
+        with self._lock:
+            creds = self._creds
+
+            try:
+                timed('oauth',creds.refresh,Request())
+                self._save(creds)
+            except Exception as e:
+                # the next get() refreshes inline instead
+                print(f"background refresh of {self.token_file} failed : {e}")
+                self._timer = None
+                return
+
+            self._schedule_refresh(creds)
+
+credential_managers = {
+    'gmail':CredentialManager('gmail_token.pickle','gmail_credentials.json',GMAIL_SCOPES),
+    'calendar':CredentialManager('calendar_token.pickle','calendar_credentials.json',SCOPES),
+}
+
+def authenticate_user_for_calender():
+    return credential_managers['calendar'].get()
 
 # Gmail API
 
 def authenticate_user_for_gmail():
-    creds = None
+    return credential_managers['gmail'].get()
 
-    if os.path.exists('gmail_token.pickle'):
-        with open('gmail_token.pickle','rb') as token:
-            creds = pickle.load(token)
+"""***Google API Services***"""
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+@lru_cache(maxsize=None)
+def get_discovery_document(api,version):
+    # the discovery documents shipped with google-api-python-client, parsed once per process
+    from googleapiclient.discovery_cache import get_static_doc
 
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'gmail_credentials.json',
-                scopes=["https://www.googleapis.com/auth/gmail.send","https://www.googleapis.com/auth/gmail.modify"]
-            )
-            creds = flow.run_local_server(port=0)
+    return get_static_doc(api,version)
 
-        with open('gmail_token.pikle','wb') as token:
-            pickle.dump(creds,token)
+_services = {}
+_services_lock = threading.Lock()
+
+def build_service(api,version,credentials):
+    import httplib2
+    import google_auth_httplib2
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.http import HttpRequest
+
+    # httplib2.Http is not thread safe, so every thread gets its own authorized transport and keeps its connections open
+    transports = threading.local()
+
+    def build_request(http,*args,**kwargs):
+        if not hasattr(transports,'http'):
+            transports.http = google_auth_httplib2.AuthorizedHttp(credentials,http=httplib2.Http())
+
+        return HttpRequest(transports.http,*args,**kwargs)
+
+    return build_from_document(
+        get_discovery_document(api,version),
+        http=google_auth_httplib2.AuthorizedHttp(credentials,http=httplib2.Http()),
+        requestBuilder=build_request
+    )
+
+def get_service(api,version,credentials):
+    # keyed by the identity of the credentials, the credential managers hand out the same object per account
+    key = (api,version,id(credentials))
+
+    with _services_lock:
+        entry = _services.get(key)
+
+        # the stored reference keeps the id from being reused by another credentials object
+        if entry is None or entry[0] is not credentials:
+            entry = (credentials,build_service(api,version,credentials))
+            _services[key] = entry
+
+    return entry[1]
+
+def execute(request,upstream='gmail',method=None):
+    return call_with_limits(upstream,request.execute,cost=quota_cost(upstream,method))
+
+def execute_batch(service,requests,upstream='gmail',method=None,batch_size=50):
+    '''
+    Runs {request_id:request} as batch HTTP requests of batch_size calls and returns
+    {request_id:(response,exception)}. Calls throttled inside a batch are retried with backoff.
+    '''
+    results = {}
+    pending = dict(requests)
+
+    for attempt in range(MAX_RETRIES+1):
+        items = list(pending.items())
+        pending = {}
+
+        for start in range(0,len(items),batch_size):
+            chunk = items[start:start+batch_size]
+
+            def callback(request_id,response,exception):
+                if exception is not None and retry_status(exception) in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    pending[request_id] = requests[request_id]
+                else:
+                    results[request_id] = (response,exception)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id,request in chunk:
+                batch.add(request,request_id=request_id)
+
+            call_with_limits(upstream,batch.execute,cost=quota_cost(upstream,method)*len(chunk))
+
+        if not pending:
+            break
+
+        rate_limiters[upstream].back_off()
+        time.sleep(backoff_delay(attempt))
+
+    return results
+
+"""***Intent Routing***"""
+
+class Intent(BaseModel):
+    '''
+    Route of the user's request together with the arguments the chosen node needs,
+    extracted in a single structured-output call
+    '''
+    route : Literal['send_mail','sort_mail','remove_labels','schedule_meeting','web_search','transcribe'] = Field(
+        ...,
+        description = "Given user's question choose to send a mail, sort mails/apply labels, remove the labels applied earlier, schedule a meeting, transcribe audio or search the web"
+    )
+    sender : Optional[str] = Field(default=None,description='send_mail : the email of sender')
+    receiver : Optional[str] = Field(default=None,description='send_mail : the email of receiver')
+    subject : Optional[str] = Field(default=None,description='send_mail : the subject of the mail')
+    message : Optional[str] = Field(default=None,description='send_mail : the message to be send in the mail')
+    attachment : Optional[str] = Field(default=None,description='send_mail : the path of the attachment with forward slashes, empty string if there is none')
+    criteria : Optional[Literal['sender','subject']] = Field(default=None,description="sort_mail : criteria 'sender' or 'subject' based on which labels are created")
+    remove_labels : Optional[bool] = Field(default=None,description='sort_mail : true if the user wants the labels to be removed right after sorting')
+    start : Optional[datetime] = Field(default=None,description='schedule_meeting : the date and time to start and join the meeting')
+    participants : Optional[list] = Field(default=None,description='schedule_meeting : list of emails of few peoples among participants')
+    meetings : Optional[list] = Field(default=None,description="schedule_meeting : when several meetings are asked for, one {'start','participants','summary'} per meeting instead of start and participants")
+    file_path : Optional[str] = Field(default=None,description='transcribe : the path of the uploaded file with forward slashes')
+    search_query : Optional[str] = Field(default=None,description='web_search : the query to search on the web')
+
+intent_prompt = '''
+    Decide what the user wants in the {query} and fill only the arguments needed for that route, leave the others empty.
+    Replace double backslashes or single backslashes of any path with forward slashes.
+    '''
+
+"""*Local Intent Classifier*"""
+
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv('INTENT_CONFIDENCE_THRESHOLD','0.85'))
+
+EMAIL_PATTERN = r'[\w.+-]+@[\w-]+\.[\w.-]+'
+AUDIO_PATH_PATTERN = r'[\w:./\\-]+\.(?:mp3|wav|m4a|flac|ogg|opus|webm|mp4|mpeg|mpga|aac|aiff?)\b'
+
+class KeywordIntentClassifier:
+    '''
+    Keyword rules for the unambiguous requests. Returns the route with a confidence,
+    or (None,0.0) when no rule or more than one route matches.
+
+    Only the read-only routes are answered with confidence, the routes which change the mailbox or
+    the calendar stay below the threshold and always go through the LLM, a question about sorting
+    or sending mail matches their keywords just as well as the request to do it. Transcription is
+    only taken for granted with an audio file or a request starting with the verb, a question
+    mentioning a transcript is left to the LLM as well.
+    '''
+    rules = [
+        ('transcribe',re.compile(rf'\b(transcribe|transcription|transcript)\b.*{AUDIO_PATH_PATTERN}|{AUDIO_PATH_PATTERN}.*\b(transcribe|transcription|transcript)\b',re.I|re.S),0.95),
+        ('transcribe',re.compile(r'^\s*(please\s+)?transcribe\b',re.I),0.95),
+        ('transcribe',re.compile(r'\b(transcribe|transcription|transcript)\b',re.I),0.5),
+        ('schedule_meeting',re.compile(r'\b(schedule|set up|book|arrange)\b.*\bmeeting\b|\bmeeting (at|on)\b',re.I|re.S),0.5),
+        ('sort_mail',re.compile(r'\b(sort|label|organi[sz]e)\b.*\b(e?mails?|inbox)\b',re.I|re.S),0.5),
+        ('remove_labels',re.compile(r'\b(remove|delete)\b.*\blabels?\b',re.I|re.S),0.5),
+        ('send_mail',re.compile(rf'\bsend\b.*{EMAIL_PATTERN}|{EMAIL_PATTERN}.*\bsend\b',re.I|re.S),0.5),
+        ('web_search',re.compile(r'^\s*(search|look up|google)\b',re.I),0.9),
+    ]
+
+    def __call__(self,question):
+        matches = {}
+        for route,pattern,confidence in self.rules:
+            if pattern.search(question):
+                matches[route] = max(confidence,matches.get(route,0.0))
+
+        if len(matches) != 1:
+            return None,0.0
+
+        return next(iter(matches.items()))
+
+    def arguments(self,route,question):
+        # whatever can be read off the question without a model, the nodes extract the rest themselves
+        if route == 'web_search':
+            return {'search_query':question}
+
+        if route == 'transcribe':
+            file_path = re.search(AUDIO_PATH_PATTERN,question,re.I)
+            return {'file_path':file_path.group(0).replace('\\','/') if file_path else None}
+
+        if route == 'sort_mail':
+            criteria = re.search(r'\b(sender|subject)\b',question,re.I)
+            return {'criteria':criteria.group(1).lower() if criteria else None,'remove_labels':False}
+
+        return {}
+
+# classifiers are tried in order before the LLM, any callable returning (route,confidence) can be added
+intent_classifiers = [KeywordIntentClassifier()]
+
+intent_classifier_stats = {'hits':0,'misses':0}
+_intent_stats_lock = threading.Lock()
+
+def classify_locally(question):
+    for classifier in intent_classifiers:
+        route,confidence = classifier(question)
+
+        if route is not None and confidence >= INTENT_CONFIDENCE_THRESHOLD:
+            arguments = classifier.arguments(route,question) if hasattr(classifier,'arguments') else {}
+            return Intent(route=route,**arguments)
+
+    return None
+
+def count_local_classification(intent):
+    with _intent_stats_lock:
+        intent_classifier_stats['hits' if intent is not None else 'misses'] += 1
+
+    return intent
+
+def classify_request(question):
+    intent = count_local_classification(classify_locally(question))
+
+    if intent is not None:
+        return intent
+
+    # one LLM round trip for both the route and the node arguments
+    return invoke_llm(get_prompt_chain(intent_prompt,Intent),{'query':question})
 
-    return creds
+async def aclassify_request(question):
+    intent = count_local_classification(classify_locally(question))
+
+    if intent is not None:
+        return intent
+
+    return await ainvoke_llm(get_prompt_chain(intent_prompt,Intent),{'query':question})
+
+def get_question(state):
+    # the question is passed either as a string, a ('user',query) tuple or a list of those
+    question = state['question']
+
+    while isinstance(question,(list,tuple)):
+        question = question[-1]
+
+    return question
 
 """***Creating Workflow and Integrating Functionality***"""
 
@@ -114,46 +1025,66 @@ class State(TypedDict):
     Attributes:
         question: question
         messages: list of messages
+        intent: route and arguments of the request, see Intent, marked 'routed' once the Router went through it
+        trace_id: id of the request's trace, see get_trace
+        account: name of the authenticated account in credential_managers, the credentials themselves never enter the state
+        storage: what Sort Mail applied, {'account','criteria','labels':[{'name','id','ids'}]}, kept by the checkpointer for a later Remove
     """
     question : List
     messages : List[str]
-    storage : Optional[list]
+    account : Optional[str]
+    storage : Optional[dict]
     file : Optional[list]
+    intent : Optional[dict]
+    trace_id : Optional[str]
+
+"""*Router*"""
+
+def given_intent(state):
+    # callers which already classified the request (app.py) pass the intent in, so it is not asked twice.
+    # an intent the router already went through was left by an earlier run on a checkpointed thread and is classified again
+    intent = state.get('intent')
+
+    if not intent or intent.get('routed'):
+        return None
 
-workflow = StateGraph(State)
+    return intent
+
+def intent_router(state:State):
+    question = get_question(state)
+
+    intent = given_intent(state) or classify_request(question).model_dump(mode='json')
+
+    return {'intent':{**intent,'routed':True},'question':question}
 
 """*Tool*"""
 
 def tool_call(state:State):
-    question = state['question'][-1]
+    question = get_question(state)
 
-    return {'messages':tools[0].invoke(question),'question':question}
+    search_query = (state.get('intent') or {}).get('search_query') or question
 
-##################################
-workflow.add_node('Web',tool_call)
-##################################
+    return {'messages':search_web(search_query),'question':question}
 
 """*Authentication*"""
 
 def gmail_authentication(state:State):
-    question = state['question'][-1]
+    question = get_question(state)
 
-    credentials = authenticate_user_for_gmail()
+    authenticate_user_for_gmail()
 
-    return {'messages':credentials,'question':question}
+    return {'account':'gmail','question':question}
 
 def calender_authentication(state:State):
-    question = state['question'][-1]
-
-    credentials = authenticate_user_for_calender()
+    question = get_question(state)
 
-    return {'messages':credentials,'question':question}
+    authenticate_user_for_calender()
 
-##########################################################
-workflow.add_node('Authenticator_1',gmail_authentication)
+    return {'account':'calendar','question':question}
 
-workflow.add_node('Authenticator_2',calender_authentication)
-###########################################################
+def get_credentials(state):
+    # the state only names the account so that it can be checkpointed, the credentials are cached by the CredentialManager
+    return authenticate_user_for_gmail() if state.get('account') == 'gmail' else authenticate_user_for_calender()
 
 """*Email Sender*"""
 
@@ -164,25 +1095,87 @@ class Email(BaseModel):
     message : str = Field(description='the message to be send in the mail')
     attachment : str = Field(description='the path of the attachment i.e., any file like pdf,audio,image etc.')
 
-email_prompt = ChatPromptTemplate.from_template(
-    '''
+email_prompt = '''
     If there is any path to the attachment in the {query} then make sure to replace the double backslash or single backslah with the forward slash.
     If there is no path to the attachment then give empty string.
     '''
-)
 
-email_llm = llm.with_structured_output(Email)
 
-email_chain = email_prompt|email_llm
+LARGE_ATTACHMENT_BYTES = int(os.getenv('LARGE_ATTACHMENT_BYTES',str(5*1024*1024)))
+UPLOAD_CHUNK_BYTES = 40*256*1024           # resumable upload chunks must be a multiple of 256KB
+ATTACHMENT_READ_BYTES = 57*1024            # multiple of 57 bytes so every block encodes to whole 76 character base64 lines
+
+def write_mime_message(output,sender_mail,receiver_mail,message,subject,attachment):
+    # writing the multipart message part by part, the attachment is base64 encoded block by block straight into output
+    boundary = f'==============={uuid.uuid4().hex}=='
+
+    # the generator would render a multipart Content-Type without parts as an empty body, so that header is written by hand
+    output.write(f'Content-Type: multipart/mixed; boundary="{boundary}"\n'.encode('ascii'))
+
+    headers = Message()
+    headers['MIME-Version'] = '1.0'
+    headers['To'] = receiver_mail
+    if sender_mail:
+        headers['From'] = sender_mail
+    headers['Subject'] = subject
 
+    output.write(headers.as_bytes())
+    output.write(f'--{boundary}\n'.encode('ascii'))
+    output.write(MIMEText(message).as_bytes())
+    output.write(f'\n--{boundary}\n'.encode('ascii'))
+
+    mime_type, _ = mimetypes.guess_type(attachment)
+
+    if mime_type is None:
+        mime_type = 'application/octet-stream'
+
+    part = Message()
+    part['Content-Type'] = mime_type
+    part['MIME-Version'] = '1.0'
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', f"attachment; filename = {attachment.split('/')[-1]}")
+
+    output.write(part.as_bytes())
+
+    with open(attachment,'rb') as file:
+        for block in iter(lambda:file.read(ATTACHMENT_READ_BYTES),b''):
+            output.write(base64.encodebytes(block))
+
+    output.write(f'\n--{boundary}--\n'.encode('ascii'))
+
+def send_large_mail(sender_mail,receiver_mail,message,subject,cred,attachment):
+    # the message goes through Gmail's resumable media upload instead of an inline base64 'raw' body
+    from googleapiclient.http import MediaFileUpload
+
+    mail_service = get_service('gmail','v1',cred)
+
+    with tempfile.TemporaryDirectory() as directory:
+        message_path = os.path.join(directory,'message.eml')
+
+        with open(message_path,'wb') as output:
+            write_mime_message(output,sender_mail,receiver_mail,message,subject,attachment)
+
+        media = MediaFileUpload(message_path,mimetype='message/rfc822',chunksize=UPLOAD_CHUNK_BYTES,resumable=True)
+        request = mail_service.users().messages().send(userId='me',body={},media_body=media)
+
+        status = response = None
+        while response is None:
+            # the send quota is charged once, the following chunks only go through the retry handling
+            status,response = call_with_limits('gmail',request.next_chunk,cost=quota_cost('gmail','messages.send') if status is None else 0)
+
+    print(f"Email sent successfully! Message ID: {response['id']}")
 
 def send_mail(sender_mail,receiver_mail,message,subject,cred,attachment=None):
-    mail_service = build('gmail','v1',credentials=cred)
+    if attachment is not None and os.path.getsize(attachment) > LARGE_ATTACHMENT_BYTES:
+        return send_large_mail(sender_mail,receiver_mail,message,subject,cred,attachment)
+
+    mail_service = get_service('gmail','v1',cred)
 
     msg = MIMEMultipart()
 
     msg['To'] = receiver_mail
-    msg['From'] = sender_mail
+    if sender_mail:
+        msg['From'] = sender_mail
     msg['Subject'] = subject
 
     body = msg.attach(MIMEText(message))
@@ -208,244 +1201,766 @@ def send_mail(sender_mail,receiver_mail,message,subject,cred,attachment=None):
     raw_message = base64.urlsafe_b64encode(msg.as_bytes()).decode('utf-8')
     body = {'raw':raw_message}
 
-    message = mail_service.users().messages().send(userId='me',body=body).execute()
+    message = execute(mail_service.users().messages().send(userId='me',body=body),method='messages.send')
     print(f"Email sent successfully! Message ID: {message['id']}")
 
-def mail_sender(state:State):
-    question = state['question'][-1]
+def mail_from_intent(intent):
+    intent = intent or {}
 
-    credential = state['messages']
+    if intent.get('receiver') and intent.get('message') is not None:
+        return Email(**{field:intent.get(field) or '' for field in Email.model_fields})
 
-    mail = email_chain.invoke(question)
+    return None
 
-    file = None
+def mail_sender(state:State):
+    question = get_question(state)
 
-    if mail.attachment != '':
-        file = mail.attachment
+    credential = get_credentials(state)
 
-    send_mail(mail.sender,mail.receiver,mail.message,subject=mail.subject,cred=credential,attachment=file)
+    mail = mail_from_intent(state.get('intent'))
 
-    return {'messages':mail.message,'question':question}
+    if mail is None:
+        mail = invoke_llm(get_prompt_chain(email_prompt,Email),question)
 
-############################################
-workflow.add_node('Mail Sender',mail_sender)
-############################################
+    send_mail(mail.sender,mail.receiver,mail.message,subject=mail.subject,cred=credential,attachment=mail.attachment or None)
+
+    return {'messages':mail.message,'question':question}
 
 """*Email labeling and Removing Labels*"""
 
-def fetch_emails(credentials,query=''):
-    service = build('gmail','v1',credentials=credentials)
+GMAIL_PAGE_SIZE = 500         # maximum allowed by users.messages.list
+GMAIL_BATCH_SIZE = 50         # Gmail recommends no more than 50 calls per batch request
+METADATA_HEADERS = ['Subject','From']
+
+def iter_message_id_pages(service,query=''):
+    # walking every page of users.messages.list, the first page alone only holds up to GMAIL_PAGE_SIZE ids
+    page_token = None
+
+    while True:
+        results = execute(service.users().messages().list(userId='me',q=query,maxResults=GMAIL_PAGE_SIZE,pageToken=page_token),method='messages.list')
+        yield [msg['id'] for msg in results.get('messages',[])]
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+def parse_email_metadata(msg_data):
+    snippet = msg_data.get("snippet", "")           # It's a small portion of the email's body text, often used to give a quick summary of what the email is about without displaying the entire content.
+    headers = msg_data.get("payload", {}).get("headers", [])         # with format='metadata' the payload only carries the requested headers
+    subject = next((h["value"] for h in headers if h["name"] == "Subject"), "No Subject")
+    sender = next((h["value"] for h in headers if h["name"] == "From"), "Unknown Sender")
+
+    return {
+        "id": msg_data["id"],
+        "subject": subject,
+        "sender": sender,
+        "snippet": snippet,
+    }
+
+def get_emails_metadata(service,ids):
+    # grouping the messages.get calls into batch HTTP requests, one round trip per GMAIL_BATCH_SIZE messages
+    requests = {
+        msg_id:service.users().messages().get(userId='me',id=msg_id,format='metadata',metadataHeaders=METADATA_HEADERS)
+        for msg_id in ids
+    }
 
-    # fetching all the unread messages from the user's Gmail account. Any emails that have been read will not be included in this list.
-    results = service.users().messages().list(userId='me',q=query).execute()
-    message = results.get('messages',[])
+    responses = execute_batch(service,requests,method='messages.get',batch_size=GMAIL_BATCH_SIZE)
 
     email_list = []
-    for msg in message:
-        msg_data = service.users().messages().get(userId="me", id=msg["id"]).execute()
-        snippet = msg_data.get("snippet", "")           # It's a small portion of the email's body text, often used to give a quick summary of what the email is about without displaying the entire content.
-        headers = msg_data.get("payload", {}).get("headers", [])         # The payload contains the core content of the message, including the headers and body. It essentially represents the entire structure of the email
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "No Subject")
-        sender = next((h["value"] for h in headers if h["name"] == "From"), "Unknown Sender")
-
-        email_list.append({
-            "id": msg["id"],
-            "subject": subject,
-            "sender": sender,
-            "snippet": snippet,
-        })
 
-    return email_list,service
+    # keeping the order of the listing, batch callbacks can arrive in any order
+    for msg_id in ids:
+        response,exception = responses[msg_id]
+
+        if exception is not None:
+            print(f"failed to fetch message {msg_id} : {exception}")
+        else:
+            email_list.append(parse_email_metadata(response))
+
+    return email_list
 
-def create_and_apply_labels(label_name,service):
-    existing_labels = service.users().labels().list(userId='me').execute()
+def get_account(service):
+    return execute(service.users().getProfile(userId='me'),method='getProfile')['emailAddress']
 
-    label_id = None
+"""*Mailbox Mirror*"""
 
-    for label in existing_labels.get('labels',[]):
-        if label['name'].lower() == label_name.lower():
-            label_id = label['id']
+MAIL_STORE_PATH = os.getenv('MAIL_STORE_PATH','mail_store.sqlite')
+MAIL_STORE_CHUNK = 500        # ids per IN (...) query, below sqlite's limit on bound parameters
+
+class MailStore:
+    '''
+    Local sqlite copy of the mailbox metadata and of the labels the agent applied, per account.
+    Sender and subject of a message never change, so a message is fetched from Gmail only once.
+    '''
+    def __init__(self,path=MAIL_STORE_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path,check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (account TEXT, id TEXT, sender TEXT, subject TEXT, snippet TEXT, PRIMARY KEY (account,id));
+            CREATE INDEX IF NOT EXISTS messages_sender ON messages (account,sender);
+            CREATE INDEX IF NOT EXISTS messages_subject ON messages (account,subject);
+            CREATE TABLE IF NOT EXISTS labels (account TEXT, id TEXT, name TEXT, PRIMARY KEY (account,id));
+            CREATE TABLE IF NOT EXISTS message_labels (account TEXT, label_id TEXT, message_id TEXT, PRIMARY KEY (account,label_id,message_id));
+            CREATE INDEX IF NOT EXISTS message_labels_message ON message_labels (account,message_id);
+        ''')
+
+        # full text search over the snippets when sqlite was built with FTS5, LIKE otherwise
+        try:
+            self._db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS snippets USING fts5(account UNINDEXED, id UNINDEXED, snippet)')
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            self.has_fts = False
+
+        self._db.commit()
+
+    def _chunks(self,ids):
+        ids = list(ids)
+        for start in range(0,len(ids),MAIL_STORE_CHUNK):
+            chunk = ids[start:start+MAIL_STORE_CHUNK]
+            yield chunk,','.join('?'*len(chunk))
+
+    def get(self,account,ids):
+        emails = {}
+
+        with self._lock:
+            for chunk,marks in self._chunks(ids):
+                rows = self._db.execute(f'SELECT id,sender,subject,snippet FROM messages WHERE account = ? AND id IN ({marks})',(account,*chunk))
+                emails.update((row[0],{'id':row[0],'sender':row[1],'subject':row[2],'snippet':row[3]}) for row in rows)
+
+        return emails
+
+    def add(self,account,emails):
+        with self._lock:
+            for email in emails:
+                inserted = self._db.execute(
+                    'INSERT OR IGNORE INTO messages (account,id,sender,subject,snippet) VALUES (?,?,?,?,?)',
+                    (account,email['id'],email['sender'],email['subject'],email['snippet'])
+                ).rowcount
+
+                if inserted and self.has_fts:
+                    self._db.execute('INSERT INTO snippets (account,id,snippet) VALUES (?,?,?)',(account,email['id'],email['snippet']))
+
+            self._db.commit()
+
+    def retain(self,account,ids):
+        # after a complete listing, whatever else the store holds was deleted from the mailbox
+        with self._lock:
+            self._db.execute('CREATE TEMP TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY)')
+            self._db.execute('DELETE FROM listed')
+            self._db.executemany('INSERT OR IGNORE INTO listed (id) VALUES (?)',((msg_id,) for msg_id in ids))
+
+            self._db.execute('DELETE FROM messages WHERE account = ? AND id NOT IN (SELECT id FROM listed)',(account,))
+            self._db.execute('DELETE FROM message_labels WHERE account = ? AND message_id NOT IN (SELECT id FROM listed)',(account,))
+            if self.has_fts:
+                self._db.execute('DELETE FROM snippets WHERE account = ? AND id NOT IN (SELECT id FROM listed)',(account,))
+
+            self._db.execute('DELETE FROM listed')
+            self._db.commit()
+
+    def add_labels(self,account,label_id,label_name,ids):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO labels (account,id,name) VALUES (?,?,?)',(account,label_id,label_name))
+            self._db.executemany('INSERT OR IGNORE INTO message_labels (account,label_id,message_id) VALUES (?,?,?)',((account,label_id,msg_id) for msg_id in ids))
+            self._db.commit()
+
+    def labels(self,account):
+        with self._lock:
+            return dict(self._db.execute('SELECT id,name FROM labels WHERE account = ?',(account,)).fetchall())
+
+    def drop_label(self,account,label_id):
+        with self._lock:
+            self._db.execute('DELETE FROM labels WHERE account = ? AND id = ?',(account,label_id))
+            self._db.execute('DELETE FROM message_labels WHERE account = ? AND label_id = ?',(account,label_id))
+            self._db.commit()
+
+    def sync_labels(self,account,existing_ids):
+        # labels deleted in Gmail itself are forgotten, their messages get labeled again
+        for label_id in set(self.labels(account))-set(existing_ids):
+            self.drop_label(account,label_id)
+
+    def groups(self,account,criteria):
+        # {sender or subject:[ids]}, the grouping a sort would apply, answered by the index
+        if criteria not in ('sender','subject'):
+            raise ValueError(f"criteria must be 'sender' or 'subject', not {criteria!r}")
+
+        groups = {}
+
+        with self._lock:
+            for value,msg_id in self._db.execute(f'SELECT {criteria},id FROM messages WHERE account = ? ORDER BY {criteria}',(account,)):
+                groups.setdefault(value,[]).append(msg_id)
+
+        return groups
+
+    def search(self,account,text,limit=50):
+        # the text is matched as one FTS5 string, quotes, dashes and operators in it are not query syntax
+        with self._lock:
+            if self.has_fts:
+                rows = self._db.execute(
+                    '''SELECT m.id,m.sender,m.subject,m.snippet FROM snippets s JOIN messages m ON m.account = s.account AND m.id = s.id
+                       WHERE snippets MATCH ? AND s.account = ? ORDER BY rank LIMIT ?''',
+                    ('"'+text.replace('"','""')+'"',account,limit)
+                ).fetchall()
+            else:
+                rows = self._db.execute(
+                    'SELECT id,sender,subject,snippet FROM messages WHERE account = ? AND snippet LIKE ? LIMIT ?',
+                    (account,f'%{text}%',limit)
+                ).fetchall()
+
+        return [{'id':row[0],'sender':row[1],'subject':row[2],'snippet':row[3]} for row in rows]
+
+@lru_cache(maxsize=None)
+def get_mail_store():
+    return MailStore()
+
+def get_mirrored_metadata(service,account,ids,store=None):
+    # the messages already in the store are read locally, only the others are fetched and added to it
+    if store is None:
+        store = get_mail_store()
+
+    emails = store.get(account,ids)
+    missing = [msg_id for msg_id in ids if msg_id not in emails]
+
+    if missing:
+        fetched = get_emails_metadata(service,missing)
+        store.add(account,fetched)
+        emails.update((email['id'],email) for email in fetched)
+
+    return [emails[msg_id] for msg_id in ids if msg_id in emails]
+
+def mirror_listing(pages,account,store=None):
+    # passes the pages of a complete listing through and drops the deleted messages from the store at the end
+    if store is None:
+        store = get_mail_store()
+
+    listed = set()
+
+    for page in pages:
+        listed.update(page)
+        yield page
+
+    store.retain(account,listed)
+
+def mailbox_groups(credentials,criteria):
+    # label decisions without an API scan, see MailStore.groups
+    return get_mail_store().groups(get_account(get_service('gmail','v1',credentials)),criteria)
+
+def search_mailbox(credentials,text,limit=50):
+    return get_mail_store().search(get_account(get_service('gmail','v1',credentials)),text,limit)
+
+"""*Incremental Sorting*"""
+
+# with a cursor saved for the account only the messages added since the last sort are fetched,
+# a run without one (first run, other criteria, labels removed, expired cursor) scans the whole mailbox
+SORT_INCREMENTAL = os.getenv('SORT_INCREMENTAL','true').lower() == 'true'
+SORT_CURSOR_PATH = os.getenv('SORT_CURSOR_PATH','sort_cursors.sqlite')
+
+class HistoryCursors:
+    '''
+    Last processed Gmail historyId per account and criteria, in a sqlite file.
+    '''
+    def __init__(self,path=SORT_CURSOR_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path,check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS history_cursors (account TEXT, criteria TEXT, history_id TEXT, PRIMARY KEY (account,criteria))')
+        self._db.commit()
+
+    def get(self,account,criteria):
+        with self._lock:
+            row = self._db.execute('SELECT history_id FROM history_cursors WHERE account = ? AND criteria = ?',(account,criteria)).fetchone()
+
+        return row[0] if row else None
+
+    def set(self,account,criteria,history_id):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO history_cursors (account,criteria,history_id) VALUES (?,?,?)',(account,criteria,str(history_id)))
+            self._db.commit()
+
+    def clear(self,account):
+        with self._lock:
+            self._db.execute('DELETE FROM history_cursors WHERE account = ?',(account,))
+            self._db.commit()
+
+@lru_cache(maxsize=None)
+def get_history_cursors():
+    return HistoryCursors()
+
+def iter_history_id_pages(service,start_history_id):
+    # ids of the messages added after start_history_id, one page of users.history.list at a time
+    page_token = None
+
+    while True:
+        results = execute(
+            service.users().history().list(userId='me',startHistoryId=start_history_id,historyTypes='messageAdded',maxResults=GMAIL_PAGE_SIZE,pageToken=page_token),
+            method='history.list'
+        )
+        yield [added['message']['id'] for record in results.get('history',[]) for added in record.get('messagesAdded',[])]
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
             break
 
-    if not label_id:
-        label = {
-            'name':label_name,
-            'labelListVisibility':'labelShow',
-            'messageListVisibility':'show'
-        }
+def new_message_id_pages(service,criteria,cursors=None):
+    '''
+    Returns (pages,account,history_id), the pages of ids added since the account's cursor
+    or of every message when there is no usable cursor, and the cursor to save once they are labeled.
+    '''
+    if cursors is None:
+        cursors = get_history_cursors()
 
-        labels = service.users().labels().create(userId='me',body=label).execute()
+    # read before listing, whatever arrives meanwhile is picked up (again) by the next run
+    profile = execute(service.users().getProfile(userId='me'),method='getProfile')
+    account = profile['emailAddress']
 
-        label_id = labels['id']
+    start_history_id = cursors.get(account,criteria) if SORT_INCREMENTAL else None
 
-    body = {'addLabelIds':[label_id]}
+    if start_history_id:
+        pages = iter_history_id_pages(service,start_history_id)
+        try:
+            # an expired cursor fails on the first page
+            first_page = next(pages,[])
+            return itertools.chain([first_page],pages),account,profile['historyId']
+        except Exception as e:
+            # Gmail keeps history for about a week, an older startHistoryId answers 404
+            if retry_status(e) != 404:
+                raise
+            print(f"history cursor of {account} expired, scanning the whole mailbox")
 
-    return body,service
+    return mirror_listing(iter_message_id_pages(service),account),account,profile['historyId']
 
+def fetch_new_emails(service,criteria,cursors=None):
+    # a message can show up in several history records
+    pages,account,history_id = new_message_id_pages(service,criteria,cursors)
+    ids = list(dict.fromkeys(msg_id for page in pages for msg_id in page))
 
-class Criteria(BaseModel):
-    criteria : str = Field(description="criteria 'sender' or 'subject' based on which labels are created")
+    return get_mirrored_metadata(service,account,ids),account,history_id
 
-criteria_llm = llm.with_structured_output(Criteria)
+"""*Pipelined Sorting*"""
 
+# metadata is fetched page by page in a background thread while the labels of the previous pages are
+# applied, only SORT_IN_FLIGHT_PAGES fetched pages are held in memory at once
+SORT_PIPELINE = os.getenv('SORT_PIPELINE','true').lower() == 'true'
+SORT_IN_FLIGHT_PAGES = int(os.getenv('SORT_IN_FLIGHT_PAGES','4'))
 
-def sort_mails(state:State):
-    question = state['question'][-1]
+def iter_email_pages(service,id_pages,account):
+    # metadata of every page of ids, a message listed twice is fetched once
+    seen = set()
 
-    credentials = state['messages']
+    for page in id_pages:
+        page = [msg_id for msg_id in page if msg_id not in seen]
+        seen.update(page)
 
-    criteria = criteria_llm.invoke(question)
+        if page:
+            yield get_mirrored_metadata(service,account,page)
 
-    emails,service = fetch_emails(credentials=credentials)
+def prefetch(iterator,max_pending):
+    '''
+    Runs the iterator in a background thread and yields its items. At most max_pending items
+    wait for the consumer, the producer pauses when the consumer falls behind.
+    '''
+    pending = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # gives up once the consumer has stopped, it would never take the item
+        while not stop.is_set():
+            try:
+                pending.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put((item,None)):
+                    return
+        except Exception as e:
+            put((done,e))
+        else:
+            put((done,None))
 
-    for email in emails:
-        label_name = email[criteria.lower()]
+    threading.Thread(target=contextvars.copy_context().run,args=(produce,),name='prefetch',daemon=True).start()
+
+    try:
+        while True:
+            item,error = pending.get()
+
+            if error is not None:
+                raise error
+            if item is done:
+                return
+
+            yield item
+    finally:
+        stop.set()
+
+FIRST_PAGE_LABELS = int(os.getenv('FIRST_PAGE_LABELS','5'))     # labels applied right after the first page, each one extra batchModify
+
+def label_pages(pages,criteria,service,label_index,account=None):
+    '''
+    Labels the pages of emails as they arrive and returns (groups,names) with groups as in
+    apply_labels_in_bulk and names the label names by id. The ids are held back per label and applied
+    once a label has BATCH_MODIFY_LIMIT of them and at the end, as in the grouped path. The
+    FIRST_PAGE_LABELS largest labels of the first page are also applied right away, which costs
+    at most that many batchModify calls more than the grouped path.
+    '''
+    groups = {}
+    names = {}
+    held = {}
+    fetched = labeled = 0
+
+    def flush(label_id):
+        nonlocal labeled
+        ids = held.pop(label_id)
+        modify_labels(service,label_id,ids,account,names[label_id])
+        labeled += len(ids)
+
+    for number,emails in enumerate(pages,1):
+        fetched += len(emails)
+
+        for email in emails:
+            label_id = label_index.get_or_create(email[criteria])
+            names[label_id] = email[criteria]
+            groups.setdefault(label_id,[]).append(email['id'])
+            held.setdefault(label_id,[]).append(email['id'])
 
-        body,service = create_and_apply_labels(label_name,service)
+            if len(held[label_id]) >= BATCH_MODIFY_LIMIT:
+                flush(label_id)
 
-        service.users().messages().modify(userId='me',id=email['id'],body=body).execute()
+        # the first labels show up without waiting for the whole mailbox
+        if number == 1:
+            for label_id in sorted(held,key=lambda label_id:len(held[label_id]),reverse=True)[:FIRST_PAGE_LABELS]:
+                flush(label_id)
 
-    return {'messages':'successfull','question':question,'storage':{'emails':emails,'service':service,'criteria':criteria.lower()}}
+        emit_progress(message=f'{fetched} emails fetched, {labeled} labeled')
 
+    for label_id in list(held):
+        flush(label_id)
 
-def delete_labels(label_name,service):
-    existing_labels = service.users().labels().list(userId='me').execute().get('labels',[])
+    return groups,names
+
+class LabelIndex:
+    '''
+    Case-insensitive name -> id index of the user's labels, listed once per run
+    and kept up to date as labels are created.
+    '''
+    def __init__(self,service):
+        self.service = service
+        existing_labels = execute(service.users().labels().list(userId='me'),method='labels.list').get('labels',[])
+        self.labels = {label['name'].lower():label['id'] for label in existing_labels}
+
+    def get(self,label_name):
+        return self.labels.get(label_name.lower())
+
+    def get_or_create(self,label_name):
+        label_id = self.get(label_name)
+
+        if not label_id:
+            label = {
+                'name':label_name,
+                'labelListVisibility':'labelShow',
+                'messageListVisibility':'show'
+            }
 
-    label_id = None
+            labels = execute(self.service.users().labels().create(userId='me',body=label),method='labels.create')
 
-    for labels in existing_labels:
-        if label_name.lower() == labels['name'].lower():
-            service.users().labels().delete(userId='me',id=labels['id']).execute()
             label_id = labels['id']
-            print(f"label ID {label_id} removed successfully")
-            break
+            self.labels[label_name.lower()] = label_id
 
-def remove_labels(state:State):
-    question = state['question'][-1]
-    credentials = state['messages']
+        return label_id
 
-    info = state['storage'][-1]
-    emails = info.get('emails')
 
-    criteria = info.get('criteria')
+BATCH_MODIFY_LIMIT = 1000     # maximum number of ids accepted by users.messages.batchModify
 
+def apply_labels_in_bulk(emails,criteria,service,label_index=None,account=None):
+    # grouping the emails by their target label so that every label costs one batchModify per 1000 messages
+    if label_index is None:
+        label_index = LabelIndex(service)
+
+    groups = {}
+    names = {}
     for email in emails:
-        label_name = email[criteria]
-        delete_labels(label_name,info.get('service'))
+        label_id = label_index.get_or_create(email[criteria])
+        names[label_id] = email[criteria]
+        groups.setdefault(label_id,[]).append(email['id'])
 
-    return {'messages':credentials,'question':question}
+    for label_id,ids in groups.items():
+        modify_labels(service,label_id,ids,account,names[label_id])
 
-#########################################
-workflow.add_node('Sort Mail',sort_mails)
-workflow.add_node('Remove',remove_labels)
-#########################################
+    return groups
 
-class Remove(BaseModel):
-    binary : str = Field(description=" 'y' to remove the labels or 'n' for not to remove the labels")
+def modify_labels(service,label_id,ids,account=None,label_name=None):
+    # every message is sent again, the label may have been taken off in Gmail since the store recorded it
+    for start in range(0,len(ids),BATCH_MODIFY_LIMIT):
+        body = {'ids':ids[start:start+BATCH_MODIFY_LIMIT],'addLabelIds':[label_id]}
+        execute(service.users().messages().batchModify(userId='me',body=body),method='messages.batchModify')
 
-remove_llm = llm.with_structured_output(Remove)
+    # with the account the labels are recorded for a later Remove
+    if account is not None:
+        get_mail_store().add_labels(account,label_id,label_name,ids)
 
-def remove_or_not(state:State):
-    question = state['question'][-1]
 
-    query = remove_llm.invoke(question)
+class Criteria(BaseModel):
+    criteria : str = Field(description="criteria 'sender' or 'subject' based on which labels are created")
+
+
+def sort_mails(state:State):
+    question = get_question(state)
+
+    credentials = get_credentials(state)
+
+    criteria = (state.get('intent') or {}).get('criteria')
+
+    if not criteria:
+        criteria = invoke_llm(get_structured_llm(Criteria),question).criteria
+
+    storage = label_mails(credentials,criteria.lower())
+
+    return {'messages':'successfull','question':question,'storage':storage}
+
+def label_mails(credentials,criteria):
+    service = get_service('gmail','v1',credentials)
+
+    label_index = LabelIndex(service)
 
-    if query == 'y':
+    if SORT_PIPELINE:
+        id_pages,account,history_id = new_message_id_pages(service,criteria)
+
+        get_mail_store().sync_labels(account,label_index.labels.values())
+
+        groups,names = label_pages(prefetch(iter_email_pages(service,id_pages,account),SORT_IN_FLIGHT_PAGES),criteria,service,label_index,account)
+    else:
+        emails,account,history_id = fetch_new_emails(service,criteria)
+
+        emit_progress(message=f'{len(emails)} emails fetched')
+
+        get_mail_store().sync_labels(account,label_index.labels.values())
+
+        groups = apply_labels_in_bulk(emails,criteria,service,label_index,account)
+        names = {label_index.get(email[criteria]):email[criteria] for email in emails}
+
+    emit_progress(message=f'{len(groups)} labels applied')
+
+    # moved only once the labels are applied, a failed run is retried from the same cursor
+    get_history_cursors().set(account,criteria,history_id)
+
+    # only ids and names are kept, enough for Remove to delete the labels later without listing anything
+    return {
+        'account':account,
+        'criteria':criteria,
+        'labels':[{'name':names[label_id],'id':label_id,'ids':ids} for label_id,ids in groups.items()],
+    }
+
+
+def delete_label_ids(names,service,account=None):
+    # deleting {label_id:label_name} in batch requests, the ids are already known so the labels are not listed
+    results = {}
+    requests = {label_id:service.users().labels().delete(userId='me',id=label_id) for label_id in names}
+
+    for label_id,(response,exception) in execute_batch(service,requests,method='labels.delete',batch_size=GMAIL_BATCH_SIZE).items():
+        label_name = names[label_id]
+
+        if exception is not None:
+            results[label_name] = f'failed : {exception}'
+        else:
+            results[label_name] = 'removed'
+            if account is not None:
+                get_mail_store().drop_label(account,label_id)
+
+    return results
+
+def remove_labels(state:State):
+    question = get_question(state)
+
+    service = get_service('gmail','v1',get_credentials(state))
+
+    # the labels saved by an earlier Sort Mail of this thread, restored by the checkpointer for a separate request,
+    # otherwise every label the agent applied to the account according to the mail store
+    storage = state.get('storage') or {}
+    account = storage.get('account') or get_account(service)
+
+    names = {label['id']:label['name'] for label in storage.get('labels') or []} or get_mail_store().labels(account)
+
+    if not names:
+        return {'messages':'no labels were applied earlier','question':question}
+
+    results = delete_label_ids(names,service,account=account)
+
+    # the labels of the earlier runs are gone, the next sort has to scan the whole mailbox again
+    get_history_cursors().clear(account)
+
+    for label_name,result in results.items():
+        print(f"label {label_name} : {result}")
+
+    return {'messages':results,'question':question,'storage':None}
+
+def remove_or_not(state:State):
+    if state['intent'].get('remove_labels'):
         return 'remove_labels'
     else:
-        return END
-
-###########################################################
-workflow.add_conditional_edges('Sort Mail',
-                               remove_or_not,
-                               {
-                                   'remove_labels':'Remove',
-                                   END:END
-                               }
-                               )
-############################################################
+        return 'end'
 
 """*Scheduling Meeting*"""
 
 class Meeting(BaseModel):
     start : datetime = Field(description='the date and time to start and join the meeting')
     participants : list = Field(description='list of emails of few peoples among participants')
+    summary : str = Field(default='Google Meet Meeting',description='the title of the meeting')
 
-meeting_llm = llm.with_structured_output(Meeting)
+class Meetings(BaseModel):
+    meetings : List[Meeting] = Field(description='every meeting asked for, one entry per meeting')
 
-meeting_llm.invoke('schedule meeting on 26 January 2025 at 18:00 pm,some participants are shivam@kl.com and hello@gmail.com')
+CALENDAR_BATCH_SIZE = 50
 
-def schedule_meetings(meeting_datetime,participants_emails,cred):
-
-    # build() Construct a Resource for interacting with an API.
-    calendar_service = build('calendar','v3',credentials=cred)
-
-    event = {
-        'summary':'Google Meet Meeting',
+def meeting_event(meeting,event_id):
+    return {
+        'id':event_id,
+        'summary':meeting.summary,
         'description':'any',
         'start':{
-            'dateTime':meeting_datetime.isoformat(),
+            'dateTime':meeting.start.isoformat(),
             'timeZone':'UTC'
         },
         'end':{
-            'dateTime':(meeting_datetime+timedelta(hours=1,minutes=0,seconds=0)).isoformat(),
+            'dateTime':(meeting.start+timedelta(hours=1,minutes=0,seconds=0)).isoformat(),
             'timeZone':'UTC'
         },
-        'attendees':[{'email':mail} for mail in participants_emails],
-        'conferenceData': {
-            'createRequest': {
-                'conferenceSolutionKey': {'type': 'hangoutsMeet'},
-                'requestId': '121'  # Unique identifier
+        'attendees':[{'email':mail} for mail in meeting.participants],
+        'conferenceData':{
+            'createRequest':{
+                'conferenceSolutionKey':{'type':'hangoutsMeet'},
+                'requestId':event_id
             }
         }
     }
 
-    # inserting event and integrating with meet
-    event = calendar_service.events().insert(
-        calendarId='primary',
-        body=event,
-        conferenceDataVersion=1
-    ).execute()
+def validate_meeting(meeting):
+    # the meetings extracted by the LLM are free-form dicts, a malformed one fails alone instead of the whole request
+    if isinstance(meeting,Meeting):
+        return meeting,None
 
-    meet_link = event['hangoutLink']
+    try:
+        return Meeting.model_validate(meeting),None
+    except ValidationError as e:
+        fields = ', '.join('.'.join(str(part) for part in error['loc']) or 'meeting' for error in e.errors())
+        return None,f'invalid meeting : {fields}'
 
-    print(f"Meeting created successfully! Google Meet Link: {meet_link}")
+def schedule_meetings_in_bulk(meetings,cred):
+    '''
+    Inserts the meetings, Meeting objects or dicts of their fields, through Calendar batch requests of
+    CALENDAR_BATCH_SIZE events and returns, in the order of the meetings, {'start','participants','meet_link','error'}
+    for every one of them. An entry which is not a valid Meeting is reported with its error and not inserted.
+    '''
+    requested = list(meetings)
+    entries = [validate_meeting(meeting) for meeting in requested]
+
+    # a Resource for interacting with the API, built once per credentials and reused
+    calendar_service = get_service('calendar','v3',cred)
+
+    # a fresh id per meeting and call, reused as event id and conference request id by the retries of
+    # this call, so a retried insert answers 409 instead of creating the meeting twice. hex digits are valid event id characters
+    event_ids = [uuid.uuid4().hex if error is None else None for meeting,error in entries]
+
+    requests = {
+        event_id:calendar_service.events().insert(calendarId='primary',body=meeting_event(meeting,event_id),conferenceDataVersion=1)
+        for (meeting,error),event_id in zip(entries,event_ids) if error is None
+    }
+
+    responses = execute_batch(calendar_service,requests,upstream='calendar',method='events.insert',batch_size=CALENDAR_BATCH_SIZE)
+
+    # 409 means an earlier attempt of this call created the event, its link is read back instead
+    existing = [event_id for event_id,(response,exception) in responses.items() if exception is not None and retry_status(exception) == 409]
+
+    if existing:
+        requests = {event_id:calendar_service.events().get(calendarId='primary',eventId=event_id) for event_id in existing}
+        responses.update(execute_batch(calendar_service,requests,upstream='calendar',method='events.get',batch_size=CALENDAR_BATCH_SIZE))
+
+    results = []
+    for requested_meeting,(meeting,error),event_id in zip(requested,entries,event_ids):
+        if error is not None:
+            fields = requested_meeting if isinstance(requested_meeting,dict) else {}
+            results.append({'start':str(fields.get('start')),'participants':fields.get('participants'),'meet_link':None,'error':error})
+            continue
+
+        response,exception = responses[event_id]
+
+        if exception is None and response.get('status') == 'cancelled':
+            error = 'the event was cancelled'
+        elif exception is not None:
+            error = f'{type(exception).__name__}: {exception}'
+        else:
+            error = None
+
+        results.append({
+            'start':meeting.start.isoformat(),
+            'participants':meeting.participants,
+            'meet_link':response.get('hangoutLink') if error is None else None,
+            'error':error,
+        })
+
+    print(f"{sum(result['error'] is None for result in results)} of {len(results)} meetings created")
+
+    return results
 
-    return meet_link
+def meetings_from_intent(intent):
+    # a structured list of meetings, or the single meeting of the intent's start and participants
+    intent = intent or {}
+
+    # validated one by one in schedule_meetings_in_bulk
+    if intent.get('meetings'):
+        return list(intent['meetings'])
+
+    if intent.get('start') and intent.get('participants'):
+        return [{'start':intent['start'],'participants':intent['participants']}]
+
+    return None
+
+def meetings_message(results):
+    if len(results) == 1 and results[0]['error'] is None:
+        return f"meeting link : {results[0]['meet_link']}"
+
+    return '\n'.join(
+        f"- {result['start']} : meeting link : {result['meet_link']}" if result['error'] is None else f"- {result['start']} : failed : {result['error']}"
+        for result in results
+    )
 
 def schedule_meeting(state:State):
-    question = state['question'][-1]
+    question = get_question(state)
 
-    credential = state['messages']
+    credential = get_credentials(state)
 
-    meeting = meeting_llm.invoke(question)
+    meetings = meetings_from_intent(state.get('intent'))
 
-    meet_link = schedule_meetings(meeting.start,meeting.participants,credential)
+    if meetings is None:
+        meetings = invoke_llm(get_structured_llm(Meetings),question).meetings
 
-    return {'messages':f"meeting link : {meet_link}",'question':question}
+    emit_progress(message=f'scheduling {len(meetings)} meetings')
 
-#############################################
-workflow.add_node('Meeting',schedule_meeting)
-#############################################
+    results = schedule_meetings_in_bulk(meetings,credential)
+
+    return {'messages':meetings_message(results),'question':question}
 
 """***meeting summarizer***"""
 
 class File(BaseModel):
     file_path : str = Field(description='the path of the uploaded file')
 
-transcription_llm = llm.with_structured_output(File)
-
-prompt = ChatPromptTemplate.from_template(
-    '''convert the double backslash of the path in the {query} to the forward slash. 
+transcription_prompt = '''convert the double backslash of the path in the {query} to the forward slash. 
     Make sure only to provide the path nothing extra than that.'''
-)
 
-transcription_chain = prompt|transcription_llm
+@lru_cache(maxsize=None)
+def get_groq_client():
+    from groq import Groq
 
-def transcription_of_audio(file_path):
-    client = Groq()
+    return Groq(max_retries=0)
+
+TRANSCRIPTION_MODEL = 'whisper-large-v3-turbo'
+TRANSCRIPTION_LANGUAGE = 'en'
+TRANSCRIPTION_TEMPERATURE = 0.2
 
-    prompt = '''
+TRANSCRIPTION_PROMPT = '''
     You are a highly skilled transcriptionist with over 15 years of experience in converting audio recordings into accurate, well-structured,
     and easy-to-read dialogue formats. Your expertise lies in capturing the nuances of conversations, including tone, pauses, and key points,
     while maintaining clarity and coherence.
@@ -454,105 +1969,588 @@ def transcription_of_audio(file_path):
     [Speaker 2] : "Yes, I've gone through it. I think we need to adjust the deadlines for phase two."
     [Speaker 1] : "Agreed. Let's discuss that in detail after we cover the budget updates."
     '''
+
+def transcription_of_audio(file_path):
+    client = get_groq_client()
+
     txt = []
 
-    with open(file_path, "rb") as audio_file:
-        content = audio_file.read()
+    # handing the open file to the client streams it into the upload instead of reading it into memory first,
+    # it is reopened on every attempt so a retry uploads from the start
+    def create():
+        with open(file_path, "rb") as audio_file:
+            return client.audio.transcriptions.create(
+                file=(os.path.basename(file_path),audio_file),
+                model=TRANSCRIPTION_MODEL,
+                prompt=TRANSCRIPTION_PROMPT,
+                response_format='json',
+                language=TRANSCRIPTION_LANGUAGE,
+                temperature=TRANSCRIPTION_TEMPERATURE
+            )
 
-    transcription = client.audio.transcriptions.create(
-        file=(file_path,content),
-        model='whisper-large-v3-turbo',
-        prompt=prompt,
-        response_format='json',
-        language='en',
-        temperature=0.2
-    )
+    transcription = call_with_limits('whisper',create)
 
     txt.append(transcription.text)
 
     return txt
 
-def transcriber(state:State):
-    question = state['question'][-1]
-
-    print(question)
-
-    file_path = transcription_chain.invoke({'query':question})
+"""*Transcription Cache*"""
 
-    print(file_path)
+TRANSCRIPTION_CACHE_DIR = os.getenv('TRANSCRIPTION_CACHE_DIR','.transcription_cache')
+TRANSCRIPTION_CACHE_MAX_BYTES = int(os.getenv('TRANSCRIPTION_CACHE_MAX_BYTES',str(256*1024*1024)))
 
-    response = transcription_of_audio(file_path.file_path)
+def audio_cache_key(file_path,block_size=1024*1024):
+    # hashing the audio in blocks, the file is never held in memory whole
+    digest = hashlib.sha256()
 
-    return {'messages':Document(page_content=response[0]),'question':question}
+    with open(file_path,'rb') as audio_file:
+        for block in iter(lambda:audio_file.read(block_size),b''):
+            digest.update(block)
 
-##############################################
-workflow.add_node('Extract Audio',transcriber)
-##############################################
+    params = {
+        'model':TRANSCRIPTION_MODEL,
+        'prompt':TRANSCRIPTION_PROMPT,
+        'language':TRANSCRIPTION_LANGUAGE,
+        'temperature':TRANSCRIPTION_TEMPERATURE,
+    }
+    digest.update(json.dumps(params,sort_keys=True).encode('utf-8'))
 
-from typing import Literal
+    return digest.hexdigest()
 
-class Route(BaseModel):
+class TranscriptionCache:
     '''
-    This class is likely used to determine where to route a user's question
+    Transcriptions stored as one json file per audio hash, the least recently used
+    files are evicted once the directory grows past max_bytes.
     '''
-    datasource :Literal['gmail_authentication','calender_authentication','transcribe_audio','web_search'] = Field(
-        ...,
-        description = "Given user's question choose to route it to gmail authentication or calender authentication or transcribing audio or web search"
+    def __init__(self,directory=TRANSCRIPTION_CACHE_DIR,max_bytes=TRANSCRIPTION_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits':0,'misses':0}
+        self._lock = threading.Lock()
+
+        os.makedirs(directory,exist_ok=True)
+
+    def _path(self,key):
+        return os.path.join(self.directory,f'{key}.json')
+
+    def get(self,key):
+        path = self._path(key)
+
+        with self._lock:
+            try:
+                with open(path,'r',encoding='utf-8') as entry:
+                    txt = json.load(entry)
+            except (OSError,ValueError):
+                self.stats['misses'] += 1
+                return None
+
+            # the modification time doubles as the last access time for eviction
+            os.utime(path)
+            self.stats['hits'] += 1
+
+            return txt
+
+    def set(self,key,txt):
+        with self._lock:
+            with tempfile.NamedTemporaryFile('w',dir=self.directory,suffix='.tmp',delete=False,encoding='utf-8') as entry:
+                json.dump(txt,entry)
+
+            os.replace(entry.name,self._path(key))
+
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.directory,name))
+                entries.append((stat.st_mtime,stat.st_size,name))
+
+        total = sum(size for _,size,_ in entries)
+
+        for _,size,name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory,name))
+            total -= size
+
+@lru_cache(maxsize=None)
+def get_transcription_cache():
+    return TranscriptionCache()
+
+"""*Audio Pre-compression*"""
+
+# speech recognition gains nothing from more than 16kHz mono, resampling and FLAC shrink the upload several times
+TRANSCRIPTION_COMPRESS_AUDIO = os.getenv('TRANSCRIPTION_COMPRESS_AUDIO','true').lower() == 'true'
+TRANSCRIPTION_SAMPLE_RATE = 16000
+COMPRESSED_BYTES_PER_SECOND = TRANSCRIPTION_SAMPLE_RATE*2     # 16 bit mono PCM, an upper bound for the FLAC output
+
+UNCOMPRESSED_AUDIO_EXTENSIONS = ('.wav','.aif','.aiff')
+
+def can_compress_audio():
+    return TRANSCRIPTION_COMPRESS_AUDIO and shutil.which('ffmpeg') is not None
+
+def should_compress_audio(file_path,file_size,duration):
+    # only when FLAC comes out smaller, mp3/m4a/ogg uploads are usually well below its bitrate already
+    if not can_compress_audio():
+        return False
+
+    if duration:
+        return file_size/duration > COMPRESSED_BYTES_PER_SECOND
+
+    return os.path.splitext(file_path)[-1].lower() in UNCOMPRESSED_AUDIO_EXTENSIONS
+
+def compress_audio(file_path,output_path,start=None,length=None):
+    # ffmpeg decodes and encodes in a stream, the output is a temp file that is later streamed into the upload
+    command = ['ffmpeg','-v','error','-y']
+
+    if start is not None:
+        command += ['-ss',str(start),'-t',str(length)]
+
+    command += ['-i',file_path,'-vn','-ac','1','-ar',str(TRANSCRIPTION_SAMPLE_RATE),'-c:a','flac',output_path]
+
+    subprocess.run(command,check=True)
+
+    return output_path
+
+"""*Long Recordings*"""
+
+TRANSCRIPTION_CHUNK_SECONDS = float(os.getenv('TRANSCRIPTION_CHUNK_SECONDS','600'))
+TRANSCRIPTION_OVERLAP_SECONDS = float(os.getenv('TRANSCRIPTION_OVERLAP_SECONDS','5'))
+TRANSCRIPTION_WORKERS = int(os.getenv('TRANSCRIPTION_WORKERS','4'))
+TRANSCRIPTION_MAX_UPLOAD_BYTES = int(os.getenv('TRANSCRIPTION_MAX_UPLOAD_BYTES',str(24*1024*1024)))    # kept under Groq's 25MB limit
+
+def audio_duration(file_path):
+    # None when ffprobe is missing or cannot read the file, the recording is then sent whole
+    if shutil.which('ffprobe') is None:
+        return None
+
+    result = subprocess.run(
+        ['ffprobe','-v','error','-show_entries','format=duration','-of','default=noprint_wrappers=1:nokey=1',file_path],
+        capture_output=True,text=True
     )
 
-route = llm.with_structured_output(Route)
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+def plan_segments(duration,file_size):
+    # chunks no longer than TRANSCRIPTION_CHUNK_SECONDS and small enough to upload, each overlapping the previous one
+    bytes_per_second = file_size / duration if duration else 0
+    chunk = TRANSCRIPTION_CHUNK_SECONDS
+
+    if bytes_per_second:
+        chunk = min(chunk,TRANSCRIPTION_MAX_UPLOAD_BYTES / bytes_per_second)
+
+    chunk = max(chunk,TRANSCRIPTION_OVERLAP_SECONDS*2)
+    step = chunk - TRANSCRIPTION_OVERLAP_SECONDS
+
+    segments = []
+    start = 0.0
+    while start < duration:
+        segments.append((start,min(chunk,duration-start)))
+        if start + chunk >= duration:
+            break
+        start += step
+
+    return segments
+
+def cut_segment(file_path,start,length,directory,index,compress=False):
+    # ffmpeg seeks and cuts the segment without loading the whole recording in this process
+    if compress:
+        return compress_audio(file_path,os.path.join(directory,f'segment_{index}.flac'),start,length)
+
+    segment_path = os.path.join(directory,f'segment_{index}{os.path.splitext(file_path)[-1]}')
+
+    subprocess.run(
+        ['ffmpeg','-v','error','-y','-ss',str(start),'-t',str(length),'-i',file_path,'-vn','-c','copy',segment_path],
+        check=True
+    )
+
+    return segment_path
+
+def stitch_transcripts(texts,max_overlap_words=60):
+    # dropping the words the overlap made a chunk repeat from the end of the previous one
+    normalize = lambda word:re.sub(r'[^\w]','',word.lower())
+
+    words = []
+
+    for text in texts:
+        new_words = text.split()
+
+        tail = [normalize(word) for word in words[-max_overlap_words:]]
+        head = [normalize(word) for word in new_words[:max_overlap_words]]
+
+        overlap = 0
+        for size in range(min(len(tail),len(head)),0,-1):
+            if tail[-size:] == head[:size]:
+                overlap = size
+                break
+
+        words.extend(new_words[overlap:])
+
+    return ' '.join(words)
+
+def transcribe_long_audio(file_path):
+    cache = get_transcription_cache()
+    key = audio_cache_key(file_path)
+
+    txt = cache.get(key)
+
+    if txt is None:
+        txt = transcribe_segments(file_path)
+        cache.set(key,txt)
+
+    return txt
+
+def transcribe_segments(file_path):
+    duration = audio_duration(file_path)
+    file_size = os.path.getsize(file_path)
 
+    compress = should_compress_audio(file_path,file_size,duration)
+
+    # segments are compressed as they are cut, so their size follows the compressed bitrate
+    if duration is not None and compress:
+        file_size = int(duration*COMPRESSED_BYTES_PER_SECOND)
+
+    if duration is None or (duration <= TRANSCRIPTION_CHUNK_SECONDS and file_size <= TRANSCRIPTION_MAX_UPLOAD_BYTES):
+        if not compress:
+            return transcription_of_audio(file_path)
+
+        with tempfile.TemporaryDirectory() as directory:
+            return transcription_of_audio(compress_audio(file_path,os.path.join(directory,'audio.flac')))
+
+    segments = plan_segments(duration,file_size)
+
+    with tempfile.TemporaryDirectory() as directory:
+        def worker(index):
+            start,length = segments[index]
+            segment_path = cut_segment(file_path,start,length,directory,index,compress)
+
+            try:
+                return transcription_of_audio(segment_path)[0]
+            finally:
+                os.remove(segment_path)
+
+        # bounded parallelism, map keeps the segments in order
+        with ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS,thread_name_prefix='transcription') as pool:
+            texts = list(pool.map(lambda index:contextvars.copy_context().run(worker,index),range(len(segments))))
+
+    return [stitch_transcripts(texts)]
+
+def transcriber(state:State):
+    from langchain_core.documents import Document
+
+    question = get_question(state)
+
+    print(question)
+
+    file_path = (state.get('intent') or {}).get('file_path')
+
+    if not file_path:
+        file_path = invoke_llm(get_prompt_chain(transcription_prompt,File),{'query':question}).file_path
+
+    print(file_path)
+
+    response = transcribe_long_audio(file_path)
+
+    return {'messages':Document(page_content=response[0]),'question':question}
 
 def authentication_router(state:State):
-    source = route.invoke(state['question'][-1])
+    route = state['intent']['route']
 
-    if source.datasource == 'gmail_authentication':
+    if route in ('send_mail','sort_mail','remove_labels'):
         return 'authenticate_mail'
-    elif source.datasource == 'calender_authentication':
+    elif route == 'schedule_meeting':
         return 'authenticate_calender'
-    elif source.datasource == 'transcribe_audio':
+    elif route == 'transcribe':
         return 'transcriber'
     else:
         return 'web_search'
 
-workflow.add_conditional_edges(
-    START,
-    authentication_router,
-    {
-        'authenticate_calender':'Authenticator_2',
-        'authenticate_mail':'Authenticator_1',
-        'transcriber':'Extract Audio',
-        'web_search':'Web'
-    }
-)
-
-class SendSort(BaseModel):
-    option : str = Field(description='send if user want to send the mail or sort if user want to sort/apply labels')
-
-sendOrsort = llm.with_structured_output(SendSort)
-
 def send_or_sort(state:State):
-    q = sendOrsort.invoke(state['question'][-1])
-
-    if q.option == 'send':
+    if state['intent']['route'] == 'send_mail':
         return 'mail_sender'
+    elif state['intent']['route'] == 'remove_labels':
+        return 'remove_labels'
     else:
         return 'apply_labels'
 
-workflow.add_conditional_edges(
-    'Authenticator_1',
-    send_or_sort,
-    {
-        'mail_sender':'Mail Sender',
-        'apply_labels':'Sort Mail'
-    })
-workflow.add_edge('Authenticator_2','Meeting')
+"""***Async Nodes***"""
+
+# The same nodes for an event loop. LLM calls use ainvoke, the blocking Google client and the
+# Groq/ffmpeg transcription pipeline run in worker threads so the loop keeps serving other requests.
+# The routers only read the intent already in the state and are shared with the sync graph.
+
+async def aintent_router(state:State):
+    question = get_question(state)
+
+    intent = given_intent(state) or (await aclassify_request(question)).model_dump(mode='json')
+
+    return {'intent':{**intent,'routed':True},'question':question}
+
+async def atool_call(state:State):
+    question = get_question(state)
+
+    search_query = (state.get('intent') or {}).get('search_query') or question
+
+    return {'messages':await asyncio.to_thread(search_web,search_query),'question':question}
+
+async def agmail_authentication(state:State):
+    question = get_question(state)
+
+    await asyncio.to_thread(authenticate_user_for_gmail)
+
+    return {'account':'gmail','question':question}
+
+async def acalender_authentication(state:State):
+    question = get_question(state)
+
+    await asyncio.to_thread(authenticate_user_for_calender)
+
+    return {'account':'calendar','question':question}
+
+async def amail_sender(state:State):
+    question = get_question(state)
+
+    credential = await asyncio.to_thread(get_credentials,state)
+
+    mail = mail_from_intent(state.get('intent'))
+
+    if mail is None:
+        mail = await ainvoke_llm(get_prompt_chain(email_prompt,Email),question)
+
+    await asyncio.to_thread(send_mail,mail.sender,mail.receiver,mail.message,subject=mail.subject,cred=credential,attachment=mail.attachment or None)
+
+    return {'messages':mail.message,'question':question}
+
+async def asort_mails(state:State):
+    question = get_question(state)
+
+    credentials = await asyncio.to_thread(get_credentials,state)
+
+    criteria = (state.get('intent') or {}).get('criteria')
+
+    if not criteria:
+        criteria = (await ainvoke_llm(get_structured_llm(Criteria),question)).criteria
+
+    storage = await asyncio.to_thread(label_mails,credentials,criteria.lower())
+
+    return {'messages':'successfull','question':question,'storage':storage}
+
+async def aremove_labels(state:State):
+    return await asyncio.to_thread(remove_labels,state)
+
+async def aschedule_meeting(state:State):
+    question = get_question(state)
+
+    credential = await asyncio.to_thread(get_credentials,state)
+
+    meetings = meetings_from_intent(state.get('intent'))
+
+    if meetings is None:
+        meetings = (await ainvoke_llm(get_structured_llm(Meetings),question)).meetings
+
+    emit_progress(message=f'scheduling {len(meetings)} meetings')
+
+    results = await asyncio.to_thread(schedule_meetings_in_bulk,meetings,credential)
+
+    return {'messages':meetings_message(results),'question':question}
+
+async def atranscriber(state:State):
+    from langchain_core.documents import Document
+
+    question = get_question(state)
+
+    file_path = (state.get('intent') or {}).get('file_path')
+
+    if not file_path:
+        file_path = (await ainvoke_llm(get_prompt_chain(transcription_prompt,File),{'query':question})).file_path
+
+    response = await asyncio.to_thread(transcribe_long_audio,file_path)
+
+    return {'messages':Document(page_content=response[0]),'question':question}
+
+"""***Graph***"""
+
+sync_nodes = {
+    'Router':intent_router,
+    'Web':tool_call,
+    'Authenticator_1':gmail_authentication,
+    'Authenticator_2':calender_authentication,
+    'Mail Sender':mail_sender,
+    'Sort Mail':sort_mails,
+    'Remove':remove_labels,
+    'Meeting':schedule_meeting,
+    'Extract Audio':transcriber,
+}
+
+async_nodes = {
+    'Router':aintent_router,
+    'Web':atool_call,
+    'Authenticator_1':agmail_authentication,
+    'Authenticator_2':acalender_authentication,
+    'Mail Sender':amail_sender,
+    'Sort Mail':asort_mails,
+    'Remove':aremove_labels,
+    'Meeting':aschedule_meeting,
+    'Extract Audio':atranscriber,
+}
+
+def build_workflow(use_async=False):
+    from langgraph.graph import StateGraph,START,END
+
+    # every node and conditional edge is timed into the request's trace, the Router opens it
+    nodes = {name:instrument(name,node,opens_trace=name == 'Router') for name,node in (async_nodes if use_async else sync_nodes).items()}
+
+    workflow = StateGraph(State)
+
+    ###########################################
+    workflow.add_node('Router',nodes['Router'])
+    ###########################################
+
+    #####################################
+    workflow.add_node('Web',nodes['Web'])
+    #####################################
+
+    #############################################################
+    workflow.add_node('Authenticator_1',nodes['Authenticator_1'])
+
+    workflow.add_node('Authenticator_2',nodes['Authenticator_2'])
+    #############################################################
+
+    #####################################################
+    workflow.add_node('Mail Sender',nodes['Mail Sender'])
+    #####################################################
+
+    #################################################
+    workflow.add_node('Sort Mail',nodes['Sort Mail'])
+    workflow.add_node('Remove',nodes['Remove'])
+    #################################################
+
+    #############################################
+    workflow.add_node('Meeting',nodes['Meeting'])
+    #############################################
+
+    #########################################################
+    workflow.add_node('Extract Audio',nodes['Extract Audio'])
+    #########################################################
+
+    workflow.add_edge(START,'Router')
+
+    workflow.add_conditional_edges(
+        'Router',
+        instrument('authentication_router',authentication_router,kind='edge'),
+        {
+            'authenticate_calender':'Authenticator_2',
+            'authenticate_mail':'Authenticator_1',
+            'transcriber':'Extract Audio',
+            'web_search':'Web'
+        }
+    )
+
+    workflow.add_conditional_edges(
+        'Authenticator_1',
+        instrument('send_or_sort',send_or_sort,kind='edge'),
+        {
+            'mail_sender':'Mail Sender',
+            'apply_labels':'Sort Mail',
+            'remove_labels':'Remove'
+        })
+    workflow.add_edge('Authenticator_2','Meeting')
+
+    workflow.add_conditional_edges('Sort Mail',
+                                   instrument('remove_or_not',remove_or_not,kind='edge'),
+                                   {
+                                       'remove_labels':'Remove',
+                                       'end':END
+                                   }
+                                   )
+
+    workflow.add_edge('Web',END)
+    workflow.add_edge('Mail Sender',END)
+    workflow.add_edge('Meeting',END)
+    workflow.add_edge('Extract Audio',END)
+    workflow.add_edge('Remove',END)
+
+    return workflow
+
+@lru_cache(maxsize=None)
+def get_workflow():
+    return build_workflow()
+
+"""*Checkpointing*"""
+
+# state of every conversation (thread_id) is saved after each node, so that a later request of the
+# same conversation, e.g. removing the labels of an earlier sort, continues from what was saved
+CHECKPOINT_PATH = os.getenv('CHECKPOINT_PATH','checkpoints.sqlite')
+
+@lru_cache(maxsize=None)
+def get_checkpointer():
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    # one connection for the process, SqliteSaver serializes the threads using it
+    return SqliteSaver(sqlite3.connect(CHECKPOINT_PATH,check_same_thread=False))
+
+def async_checkpointer():
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    # the aiosqlite connection belongs to the running loop, so it is opened per call
+    return AsyncSqliteSaver.from_conn_string(CHECKPOINT_PATH)
+
+def thread_config(thread_id):
+    return {'configurable':{'thread_id':thread_id}} if thread_id else None
+
+def is_checkpointed(config):
+    return bool((config or {}).get('configurable',{}).get('thread_id'))
+
+@lru_cache(maxsize=None)
+def get_graph(checkpointed=False):
+    # compiled once, on the first request that needs it
+    return get_workflow().compile(checkpointer=get_checkpointer() if checkpointed else None)
+
+@lru_cache(maxsize=None)
+def get_async_workflow():
+    return build_workflow(use_async=True)
+
+@lru_cache(maxsize=None)
+def get_async_graph():
+    return get_async_workflow().compile()
+
+async def ainvoke_graph(inputs,config=None):
+    if not is_checkpointed(config):
+        return await get_async_graph().ainvoke(inputs,config)
+
+    async with async_checkpointer() as checkpointer:
+        return await get_async_workflow().compile(checkpointer=checkpointer).ainvoke(inputs,config)
+
+async def astream_graph(inputs,config=None,stream_mode='values'):
+    if not is_checkpointed(config):
+        async for event in get_async_graph().astream(inputs,config,stream_mode=stream_mode):
+            yield event
+        return
+
+    async with async_checkpointer() as checkpointer:
+        async for event in get_async_workflow().compile(checkpointer=checkpointer).astream(inputs,config,stream_mode=stream_mode):
+            yield event
+
+
+# `from main_workflow import graph` keeps working, the graph is only compiled when the name is first looked up
+_lazy_attributes = {
+    'workflow':get_workflow,
+    'graph':get_graph,
+    'async_graph':get_async_graph,
+    'llm':get_llm,
+    'tools':get_tools,
+    'wiki_tool':get_wiki_tool,
+}
 
-workflow.add_edge('Web',END)
-workflow.add_edge('Mail Sender',END)
-workflow.add_edge('Meeting',END)
-workflow.add_edge('Extract Audio',END)
+def __getattr__(name):
+    if name in _lazy_attributes:
+        return _lazy_attributes[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-graph = workflow.compile()
+__all__ = ['render_metrics','get_trace','start_metrics_server','workflow','graph','get_graph','build_workflow','get_checkpointer','thread_config','async_graph','get_async_graph','ainvoke_graph','astream_graph','classify_request','aclassify_request','Intent','intent_classifiers','intent_classifier_stats','mailbox_groups','search_mailbox','schedule_meetings_in_bulk','transcription_of_audio','transcribe_long_audio']
 
-__all__ = ['workflow','graph','transcription_of_audio']
+IMPORT_SECONDS = time.perf_counter() - _import_started